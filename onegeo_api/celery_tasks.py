@@ -14,6 +14,7 @@
 # under the License.
 
 
+from celery import chord
 from celery.decorators import task
 # from celery.signals import after_task_publish
 from celery.signals import before_task_publish
@@ -26,11 +27,22 @@ from celery.signals import task_success
 from celery.signals import task_unknown
 from celery.task.control import revoke
 from celery.utils.log import get_task_logger
+from copy import deepcopy
 from django.apps import apps
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.dispatch import Signal
 from django.utils import timezone
+import itertools
+import os
+from onegeo_api import pdf
 from onegeo_api.elastic import elastic_conn
+from onegeo_api.elastic import Failures
+from onegeo_api.elastic import FAILURES_DIR
+from onegeo_api.elastic import partition_of
+from onegeo_api.elastic import plan_index_settings
 from onegeo_api.models.analysis import get_complete_analysis
+from onegeo_api.utils import json_dumps
 from uuid import UUID
 
 
@@ -42,12 +54,33 @@ Resource = apps.get_model(app_label='onegeo_api', model_name='Resource')
 Source = apps.get_model(app_label='onegeo_api', model_name='Source')
 Task = apps.get_model(app_label='onegeo_api', model_name='Task')
 IndexProfile = apps.get_model(app_label='onegeo_api', model_name='IndexProfile')
+IndexManifest = apps.get_model(app_label='onegeo_api', model_name='IndexManifest')
+
+
+# Sent once the alias of an `IndexProfile` targets its new index
+index_built = Signal(providing_args=['instance', 'index'])
+
+
+# Tasks logged as `Task` entries (unlike the partitions of an indexing)
+LOGGED_TASKS = ('data_source_analyzing', 'indexing')
+
+# Number of subtasks an index is built by (when built from scratch).
+# The source cannot be paged: each subtask reads it in full and keeps
+# its share of the documents, so the source is read as many times.
+INDEXING_PARTITIONS = getattr(settings, 'ONEGEO_INDEXING_PARTITIONS', 1)
+
+# Documents read to size the first index of a source (0 disables)
+VOLUME_SAMPLE_SIZE = getattr(settings, 'ONEGEO_VOLUME_SAMPLE_SIZE', 1000)
 
 
 @before_task_publish.connect
 def on_beforehand(headers=None, body=None, sender=None, **kwargs):
     """Create a model-task entry and kill all celery-tasks from same sender."""
+    if sender not in LOGGED_TASKS:
+        return
     uuid = headers['id']
+    if Task.logged.filter(uuid=UUID(uuid)).exists():
+        return  # Retried task
     alias = Alias.objects.get(pk=body[1]['alias'])
     user = User.objects.get(pk=body[1]['user'])
     resource_ns = body[1]['resource_ns']
@@ -55,7 +88,9 @@ def on_beforehand(headers=None, body=None, sender=None, **kwargs):
     details = None
 
     if sender == 'indexing':
-        details = {'index': body[1]['index']}
+        details = {'index': body[1]['index'],
+                   'force_update': body[1].get('force_update', False),
+                   'in_place': body[1].get('in_place', False)}
     else:
         details = None
 
@@ -66,12 +101,38 @@ def on_beforehand(headers=None, body=None, sender=None, **kwargs):
     if len(related_tasks) > 0:
         for related_task in related_tasks:
             revoke(related_task.uuid, terminate=True)
+
+    if sender == 'indexing':
+        discard_checkpoints(alias, keep=body[1].get('resume'))
     # then
     Task.asynchronous.create(
         uuid=UUID(uuid), alias=alias, details=details,
         task_name=sender, user=user, resource_ns=resource_ns)
 
 
+def discard_checkpoints(alias, keep=None):
+    """Delete the indices left by the interrupted indexing tasks."""
+    tasks = Task.logged.filter(
+        alias=alias, task_name='indexing', details__has_key='checkpoint')
+    for interrupted in tasks:
+        if keep and str(interrupted.uuid) == str(keep):
+            continue
+        cancel_reindex(interrupted.details)
+        index = interrupted.details['checkpoint'].get('index')
+        if index:
+            elastic_conn.discard_index(index, str(alias.pk))
+        del interrupted.details['checkpoint']
+        interrupted.save()
+
+
+def cancel_reindex(details):
+    # A killed task has not cancelled its server-side reindex, which
+    # would create the index again once it is deleted
+    reindex_task = ((details or {}).get('reindex') or {}).get('task')
+    if reindex_task:
+        elastic_conn.cancel_task(reindex_task)
+
+
 # @task_prerun.connect
 # def on_task_prerun(**kwargs):
 #     pass
@@ -79,20 +140,31 @@ def on_beforehand(headers=None, body=None, sender=None, **kwargs):
 
 @task_revoked.connect
 def on_task_revoked(task_id=None, sender=None, request=None, **kwargs):
+    if sender.name not in LOGGED_TASKS:
+        return
     task = Task.logged.get(uuid=UUID(request.id))
+    checkpoint = (task.details or {}).get('checkpoint')
     if sender.__qualname__ == 'indexing':
+        cancel_reindex(task.details)
+    if sender.__qualname__ == 'indexing' and not checkpoint:
         index = task.details.get('index')
-        if index:
-            elastic_conn.delete_index(index)
+        # The index may not be created yet, or be updated in place
+        if index and not task.details.get('in_place'):
+            elastic_conn.discard_index(index, str(task.alias.pk))
 
     task.success = False
     task.details = {'reason': 'revoked'}
+    if checkpoint:
+        # The index is kept so that the task could be resumed
+        task.details['checkpoint'] = checkpoint
     task.stop_date = timezone.now()
     task.save()
 
 
 @task_rejected.connect
 def on_task_rejected(task_id=None, sender=None, request=None, **kwargs):
+    if sender.name not in LOGGED_TASKS:
+        return
     task = Task.logged.get(uuid=UUID(request.id))
     if sender.__qualname__ == 'indexing':
         elastic_conn.delete_index(task.details.get('index'))
@@ -105,6 +177,8 @@ def on_task_rejected(task_id=None, sender=None, request=None, **kwargs):
 
 @task_unknown.connect
 def on_task_unknown(task_id=None, sender=None, request=None, **kwargs):
+    if sender.name not in LOGGED_TASKS:
+        return
     task = Task.logged.get(uuid=UUID(request.id))
     if sender.__qualname__ == 'indexing':
         elastic_conn.delete_index(task.details.get('index'))
@@ -123,20 +197,35 @@ def on_task_failure(task_id=None, sender=None, exception=None, **kwargs):
     else:
         details = exception.__str__()
 
-    Task.logged.filter(uuid=UUID(task_id)).update(
-        success=False, details={'reason': 'error', 'details': details})
+    task = Task.logged.filter(uuid=UUID(task_id)).first()
+    if not task:
+        return
+    checkpoint = (task.details or {}).get('checkpoint')
+    task.success = False
+    task.details = {'reason': 'error', 'details': details}
+    if checkpoint:
+        task.details['checkpoint'] = checkpoint
+    task.save()
 
 
 @task_success.connect
 def on_task_success(sender=None, **kwargs):
+    result = kwargs.get('result')
+    if isinstance(result, dict) and result.get('dispatched'):
+        # The task goes on in a chord, whose callback will end it
+        Task.logged.filter(uuid=UUID(sender.request.id)).update(
+            details=result)
+        return
     Task.logged.filter(uuid=UUID(sender.request.id)).update(
-        success=True, details=kwargs.get('result'))
+        success=True, details=result)
 
 
 @task_postrun.connect
-def on_task_postrun(task_id=None, **kwargs):
-    if task_id:
-        task = Task.logged.get(uuid=UUID(task_id))
+def on_task_postrun(task_id=None, retval=None, **kwargs):
+    if isinstance(retval, dict) and retval.get('dispatched'):
+        return
+    task = task_id and Task.logged.filter(uuid=UUID(task_id)).first()
+    if task:
         task.stop_date = timezone.now()
         task.save()
 
@@ -157,16 +246,14 @@ def data_source_analyzing(alias=None, source=None, user=None, resource_ns=None):
             'title': title, 'typename': item.name, 'user': source.user})
 
 
-@task(name='indexing', ignore_result=False)
-def indexing(alias=None, index_profile=None, index=None,
-             user=None, resource_ns=None, force_update=False):
-
-    user = User.objects.get(pk=user)
-    index_profile = IndexProfile.objects.get(pk=index_profile)
+def configure_columns(index_profile):
+    """Apply the columns of `index_profile` to its onegeo counterpart.
 
+    Return the columns mapping and the analyzers in use.
+    """
     columns_mapping = {}
     analyzers = []
-    for col in iter(index_profile.columns):
+    for col in iter(deepcopy(index_profile.columns)):
 
         name = col.pop('name')
         alias = col.get('alias')
@@ -198,32 +285,295 @@ def indexing(alias=None, index_profile=None, index=None,
             analyzers.append(search_analyzer)
         index_profile.onegeo.update_property(name, 'search_analyzer', search_analyzer)
 
+    return columns_mapping, analyzers
+
+
+def is_pdf(index_profile):
+    return index_profile.onegeo.resource.source.protocol == 'pdf'
+
+
+def get_collection(index_profile, partition=0, partitions=1):
+    collection = index_profile.onegeo.get_collection()
+    if is_pdf(index_profile) and pdf.PDF_EXTRACTION == 'local':
+        if partitions > 1:
+            # Not to extract the documents of the other partitions
+            collection = (
+                document for document in collection
+                if partition_of(document['_md5'], partitions) == partition)
+        return pdf.iter_extracted(collection)
+    return collection
+
+
+def estimate_volume(index_profile):
+    """Return the number of documents and the size (in bytes) expected.
+
+    Taken from the live index if any, else from the first documents of
+    the source, as JSON. Unknown (None) if disabled, or if the source
+    holds more than `VOLUME_SAMPLE_SIZE` documents, as it is not counted.
+    """
+    volume = elastic_conn.estimate_volume(
+        index_profile.uuid, sample_size=VOLUME_SAMPLE_SIZE)
+    if volume or not VOLUME_SAMPLE_SIZE:
+        return volume
+
+    count = size = 0
+    for document in itertools.islice(
+            index_profile.onegeo.get_collection(), VOLUME_SAMPLE_SIZE + 1):
+        count += 1
+        size += len(json_dumps(document))
+    if not count or count > VOLUME_SAMPLE_SIZE:
+        return None
+    return count, size
+
+
+def get_failures(task_id):
+    """Return the `Failures` of a task, spilled to a file if configured."""
+    spill = None
+    if FAILURES_DIR:
+        os.makedirs(FAILURES_DIR, exist_ok=True)
+        spill = os.path.join(FAILURES_DIR, '{}.ndjson.gz'.format(task_id))
+    return Failures(spill=spill)
+
+
+def notify_built(index_profile, index):
+    # The index is live whatever the receivers do
+    for receiver, e in index_built.send_robust(
+            sender=IndexProfile, instance=index_profile, index=index):
+        if e:
+            logger.warning('{0} failed on index {1}: {2}'.format(
+                receiver.__name__, index, e))
+
+
+@task(name='indexing', ignore_result=False)
+def indexing(alias=None, index_profile=None, index=None, user=None,
+             resource_ns=None, force_update=False, in_place=False, resume=None,
+             partitions=None):
+
+    user = User.objects.get(pk=user)
+    index_profile = IndexProfile.objects.get(pk=index_profile)
+    columns = deepcopy(index_profile.columns)
+
+    # Resume either the given task or this one (if it is retried)
+    position = 0
+    if not in_place:
+        previous = Task.logged.filter(
+            uuid=UUID(resume or indexing.request.id)).first()
+        last_checkpoint = \
+            previous and (previous.details or {}).get('checkpoint')
+        if last_checkpoint and last_checkpoint.get('index') == index:
+            # The resumed build may have been completed already
+            if index in elastic_conn.get_indices_by_alias(
+                    index_profile.uuid, fresh=True):
+                raise ValueError(
+                    "Index '{}' is live, there is nothing to resume.".format(
+                        index))
+            position = last_checkpoint.get('position', 0)
+            # The build goes on the way it was started
+            force_update = last_checkpoint.get('force_update', force_update)
+
+    columns_mapping, analyzers = configure_columns(index_profile)
+
+    if not force_update and not position and elastic_conn.rename_columns(
+            index_profile.uuid, columns, columns_mapping):
+        return {'renamed': True}
+
     mappings = index_profile.onegeo.generate_elastic_mapping()
+    mapping = mappings.get('foo')
+    mapping['_meta'] = {'columns': columns, 'columns_mapping': columns_mapping}
+
+    index_settings = plan_index_settings(
+        *(estimate_volume(index_profile) or ()),
+        data_nodes=elastic_conn.count_data_nodes(),
+        overrides=index_profile.index_settings)
 
     body = {
         'mappings': {
-            index: mappings.get('foo')},
-        'settings': {
-            'codec': 'best_compression',
-            'number_of_replicas': 0,
-            'analysis': get_complete_analysis(analyzer=analyzers, user=user)}}
+            index: mapping},
+        'settings': dict(
+            index_settings,
+            analysis=get_complete_analysis(analyzer=analyzers, user=user))}
 
-    if index_profile.onegeo.resource.source.protocol == 'pdf':
+    if is_pdf(index_profile) and pdf.PDF_EXTRACTION == 'ingest':
         pipeline = elastic_conn.create_pipeline()
     else:
         pipeline = False
 
-    created, reindexed, failed = elastic_conn.create_or_reindex(
-        index=index, body=body, alias=index_profile.uuid,
-        collection=index_profile.onegeo.get_collection(),
-        columns_mapping=columns_mapping, update=force_update,
-        pipeline=pipeline)
+    details = {'index': index, 'force_update': force_update,
+               'in_place': in_place}
+
+    def save_details(**kwargs):
+        details.update(kwargs)
+        Task.logged.filter(uuid=UUID(indexing.request.id)).update(
+            details=details)
+
+    def progress(status):
+        save_details(reindex=status)
+
+    def checkpoint(position):
+        # Whatever is needed to resume, as the rest of the details
+        # is replaced when the task is interrupted
+        save_details(checkpoint={'index': index, 'position': position,
+                                 'force_update': force_update})
+
+    if partitions is None:
+        partitions = INDEXING_PARTITIONS
+    if partitions > 1 and not in_place and not position:
+        # The index is built from scratch by as many subtasks
+        target_settings = elastic_conn.create_index_for_build(index, body)
+        chord(
+            indexing_partition.s(
+                index=index, index_profile=index_profile.pk,
+                columns_mapping=columns_mapping, pipeline=pipeline,
+                partition=i, partitions=partitions)
+            for i in range(partitions))(
+            indexing_complete.s(
+                task_id=indexing.request.id, index=index,
+                alias=index_profile.uuid, index_profile=index_profile.pk,
+                target_settings=target_settings
+            ).on_error(
+                indexing_abort.s(task_id=indexing.request.id, index=index)))
+        return {'index': index, 'partitions': partitions, 'dispatched': True}
+
+    manifest = IndexManifest.objects.filter(
+        index_profile=index_profile).first()
+
+    stats = {}
+    failed = get_failures(indexing.request.id)
+    updated = None
+    try:
+        if in_place:
+            # Falls back to a full build when the columns have changed
+            updated = elastic_conn.update_in_place(
+                alias=index_profile.uuid,
+                collection=get_collection(index_profile),
+                columns=columns, columns_mapping=columns_mapping,
+                pipeline=pipeline, stats=stats, manifest=manifest,
+                failures=failed)
+
+        if updated:
+            index, created, reindexed, _ = updated
+        else:
+            if in_place:
+                # A new index it is, to be deleted if the task is revoked
+                save_details(in_place=False)
+            created, reindexed, _ = elastic_conn.create_or_reindex(
+                index=index, body=body, alias=index_profile.uuid,
+                collection=get_collection(index_profile),
+                columns_mapping=columns_mapping, update=force_update,
+                pipeline=pipeline, stats=stats, progress=progress,
+                manifest=manifest, checkpoint=checkpoint, resume=position,
+                failures=failed)
+    finally:
+        failed.close()
+
+    if position and resume:
+        # The interrupted task is not to be resumed again
+        previous_details = dict(previous.details)
+        previous_details.pop('checkpoint', None)
+        Task.logged.filter(uuid=previous.uuid).update(
+            details=previous_details)
+
+    notify_built(index_profile, index)
+
+    # The documents indexed by the interrupted task are not known. Those
+    # which failed would be taken as unchanged by the next update.
+    if not stats.get('resumed') and not failed.incomplete:
+        IndexManifest.record(
+            index_profile, index, columns_mapping,
+            (reindexed | created) - failed.ids)
 
     res = {}
+    if updated:
+        res['in_place'] = True
+    else:
+        res['settings'] = index_settings
     if created:
         res['created'] = len(created)  # {'count': len(created), 'ids': created}
     if reindexed:
         res['reindexed'] = len(reindexed)  # {'count': len(reindexed), 'ids': reindexed}
+    if stats.get('removed'):
+        res['removed'] = stats['removed']
+    if stats.get('resumed'):
+        res['resumed'] = stats['resumed']
     if failed:
-        res['failed'] = {'count': len(failed), 'details': failed}
+        res['failed'] = failed.summary()
+    if stats.get('batches'):
+        res['batches'] = stats['batches']
+    if stats.get('prefetch'):
+        res['prefetch'] = stats['prefetch']
     return res
+
+
+@task(name='indexing_partition', ignore_result=False)
+def indexing_partition(index=None, index_profile=None, columns_mapping=None,
+                       pipeline=False, partition=0, partitions=1):
+
+    index_profile = IndexProfile.objects.get(pk=index_profile)
+    configure_columns(index_profile)
+
+    stats = {}
+    failed = get_failures(indexing_partition.request.id)
+    try:
+        created, _ = elastic_conn.index_partition(
+            index, get_collection(index_profile, partition, partitions),
+            columns_mapping, partition=partition, partitions=partitions,
+            pipeline=pipeline, stats=stats, failures=failed)
+    except Exception as e:
+        # The chord fails once every partition is over, those left stop
+        # as soon as the index is deleted.
+        if elastic_conn.is_index_exists(index=index):
+            elastic_conn.delete_index(index)
+        raise e
+    finally:
+        failed.close()
+
+    # Ids of a partition are distinct from those of the others
+    return {'created': len(created), 'failed': failed.summary(),
+            'batches': stats.get('batches'), 'prefetch': stats.get('prefetch')}
+
+
+@task(name='indexing_complete', ignore_result=False)
+def indexing_complete(results, task_id=None, index=None, alias=None,
+                      index_profile=None, target_settings=None):
+
+    created = sum(result['created'] for result in results)
+    failed = Failures()
+    for result in results:
+        failed.update(result['failed'])
+
+    # Failing, the build is aborted by the errback
+    elastic_conn.complete_build(
+        index, alias, target_settings=target_settings, count=created)
+
+    if index_profile:
+        notify_built(IndexProfile.objects.get(pk=index_profile), index)
+
+    res = {'partitions': len(results)}
+    if created:
+        res['created'] = created
+    if failed:
+        res['failed'] = failed.summary()
+    res['batches'] = [result['batches'] for result in results]
+    res['prefetch'] = [result['prefetch'] for result in results]
+
+    Task.logged.filter(uuid=UUID(task_id)).update(
+        success=True, details=res, stop_date=timezone.now())
+
+
+@task(name='indexing_abort', ignore_result=True)
+def indexing_abort(request=None, exc=None, traceback=None,
+                   task_id=None, index=None, reason=None):
+    # Called as an errback, with the request and the exception of the
+    # failed task (either a partition or the callback of the chord)
+    if index and elastic_conn.is_index_exists(index=index):
+        elastic_conn.delete_index(index)
+
+    if exc is not None and not reason:
+        if exc.__class__.__qualname__ == 'ElasticError' \
+                and getattr(exc, 'details', None):
+            reason = exc.description
+        else:
+            reason = str(exc)
+    Task.logged.filter(uuid=UUID(task_id)).update(
+        success=False, stop_date=timezone.now(),
+        details={'reason': 'error', 'details': reason or 'partition failed'})
@@ -14,24 +14,169 @@
 # under the License.
 
 
+from collections import Counter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
 # from django.http import Http404
 from elasticsearch import Elasticsearch
+from elasticsearch.client.utils import _make_path
 from elasticsearch import exceptions
 # from elasticsearch import helpers
 from functools import wraps
-import gc
+import gzip
+import heapq
 import itertools
+import json
+import logging
 from onegeo_api.exceptions import ElasticError
-from onegeo_api.utils import estimate_size
+from onegeo_api.utils import chunked
+from onegeo_api.utils import Cursor
+from onegeo_api.utils import DigestSet
+from onegeo_api.utils import json_dumps
+from onegeo_api.utils import map_blocks
+from onegeo_api.utils import Prefetcher
 from onegeo_api.utils import Singleton
-import operator
+from queue import Full
+from queue import Queue
+import random
+import threading
+import time
+import zlib
 # import json
 # from io import StringIO
 
 
+logger = logging.getLogger(__name__)
+
+
 HOSTS = settings.ELASTICSEARCH_HOSTS
 
+# Number of bulk requests sent concurrently to Elasticsearch
+BULK_THREAD_COUNT = getattr(settings, 'ELASTICSEARCH_BULK_THREAD_COUNT', 4)
+# Number of bulk bodies waiting (in-flight included) before the producer blocks
+BULK_QUEUE_SIZE = getattr(settings, 'ELASTICSEARCH_BULK_QUEUE_SIZE', 8)
+# Dotted path to a callable serializing an object to JSON (`str` or `bytes`)
+BULK_SERIALIZER = import_string(getattr(
+    settings, 'ELASTICSEARCH_BULK_SERIALIZER', 'onegeo_api.utils.json_dumps'))
+# Round-trip time (in seconds) the bulk batch size is adjusted to
+BULK_TARGET_LATENCY = getattr(settings, 'ELASTICSEARCH_BULK_TARGET_LATENCY', 2.0)
+# Bounds of the batch size, in number of documents then in bytes
+BULK_DOCS_RANGE = getattr(
+    settings, 'ELASTICSEARCH_BULK_DOCS_RANGE', (10, 10000))
+BULK_BYTES_RANGE = getattr(
+    settings, 'ELASTICSEARCH_BULK_BYTES_RANGE', (1048576, 104857600))
+# Number of times a temporarily rejected document is sent again
+BULK_MAX_RETRIES = getattr(settings, 'ELASTICSEARCH_BULK_MAX_RETRIES', 5)
+# Initial and maximum delays (in seconds) before sending it again
+BULK_BACKOFF = getattr(settings, 'ELASTICSEARCH_BULK_BACKOFF', (1, 60))
+
+# Number of slices (and threads) used to scroll through an index
+SCROLL_SLICES = getattr(settings, 'ELASTICSEARCH_SCROLL_SLICES', 4)
+# Copy unchanged documents with a single asynchronous `_reindex` task
+ASYNC_REINDEX = getattr(settings, 'ELASTICSEARCH_ASYNC_REINDEX', True)
+# Delay (in seconds) between two polls of the `_reindex` task
+REINDEX_POLL_INTERVAL = getattr(
+    settings, 'ELASTICSEARCH_REINDEX_POLL_INTERVAL', 5)
+# Number of documents per scroll batch of the `_reindex` task
+REINDEX_BATCH_SIZE = 1000
+
+REINDEX_PROGRESS_KEYS = (
+    'total', 'created', 'updated', 'deleted', 'batches',
+    'version_conflicts', 'noops')
+
+# Processes encoding the documents into bulk actions (0 disables)
+PREPARE_PROCESSES = getattr(settings, 'ONEGEO_PREPARE_PROCESSES', 0)
+# Number of documents handed to a process at once
+PREPARE_CHUNK_SIZE = getattr(settings, 'ONEGEO_PREPARE_CHUNK_SIZE', 500)
+# Number of source documents read ahead of the bulk requests (0 disables)
+PREFETCH_SIZE = getattr(settings, 'ONEGEO_PREFETCH_SIZE', 1000)
+# Build new indices with refresh disabled, async translog and no replicas
+BULK_LOAD = getattr(settings, 'ELASTICSEARCH_BULK_LOAD', True)
+# Time to wait for the new index to turn green before switching aliases
+BULK_LOAD_HEALTH_TIMEOUT = getattr(
+    settings, 'ELASTICSEARCH_BULK_LOAD_HEALTH_TIMEOUT', '5m')
+
+BULK_LOAD_SETTINGS = {
+    'refresh_interval': '-1',
+    'translog.durability': 'async',
+    'number_of_replicas': 0}
+
+# Segments a new index is merged down to before going live (0 disables).
+# Not for indices later updated in place, which keep being written to.
+WARMUP_SEGMENTS = getattr(settings, 'ELASTICSEARCH_WARMUP_SEGMENTS', 0)
+# Time (in seconds) to wait for the merge, which goes on past this delay
+WARMUP_TIMEOUT = getattr(settings, 'ELASTICSEARCH_WARMUP_TIMEOUT', 3600)
+# Queries (bodies) run against every new index before it goes live
+WARMUP_QUERIES = getattr(settings, 'ONEGEO_WARMUP_QUERIES', [])
+# Latest queries of each index kept in the cache, then run against the
+# next index as well (0 disables)
+WARMUP_RECENT_QUERIES = getattr(settings, 'ONEGEO_WARMUP_RECENT_QUERIES', 20)
+# Share of the searches whose query is kept, so as to spare most of them
+# the round trips to the cache
+WARMUP_SAMPLE_RATE = getattr(settings, 'ONEGEO_WARMUP_SAMPLE_RATE', 0.01)
+
+# Former indices kept per alias, which can be rolled back to
+KEEP_GENERATIONS = getattr(settings, 'ONEGEO_KEEP_GENERATIONS', 0)
+# Close the former indices kept (rather than dropping their replicas)
+CLOSE_GENERATIONS = getattr(settings, 'ONEGEO_CLOSE_GENERATIONS', False)
+# Alias of the indices of every search model (searched as `_all`)
+GLOBAL_ALIAS = getattr(settings, 'ONEGEO_GLOBAL_ALIAS', 'onegeo')
+
+# Time (in seconds) the aliases of the indices are kept in process
+ALIASES_CACHE_TTL = getattr(settings, 'ELASTICSEARCH_ALIASES_CACHE_TTL', 30)
+
+# Size (in bytes) aimed at for a primary shard, sizes being those of the
+# documents as JSON (see `estimate_volume`)
+SHARD_SIZE = getattr(settings, 'ELASTICSEARCH_SHARD_SIZE', 32212254720)
+# Maximum number of primary shards of an index
+MAX_SHARDS = getattr(settings, 'ELASTICSEARCH_MAX_SHARDS', 32)
+# Replicas of an index, as long as there are enough data nodes
+REPLICAS = getattr(settings, 'ELASTICSEARCH_REPLICAS', 1)
+# Size (in bytes) from which an index is stored with `best_compression`
+COMPRESSION_SIZE = getattr(settings, 'ELASTICSEARCH_COMPRESSION_SIZE', 1073741824)
+# Size (in bytes) from which an index is refreshed less often
+SLOW_REFRESH_SIZE = getattr(settings, 'ELASTICSEARCH_SLOW_REFRESH_SIZE', 10737418240)
+SLOW_REFRESH_INTERVAL = '30s'
+
+# Stored script remapping the columns of a document, where `params.rename`
+# and `params.add` map raw column names to their new names, and
+# `params.remove` lists the raw names of the columns to drop. The current
+# name of a column is read from the `_columns_mapping` of each document.
+REMAP_COLUMNS_SCRIPT_ID = 'onegeo-remap-columns'
+REMAP_COLUMNS_SCRIPT = """
+def properties = ctx._source.properties;
+def mapping = ctx._source._columns_mapping;
+for (raw in params.remove) {
+    if (mapping.containsKey(raw)) {
+        properties.remove(mapping.remove(raw));
+    }
+}
+for (entry in params.rename.entrySet()) {
+    def old = mapping.get(entry.getKey());
+    if (old != null && old != entry.getValue()) {
+        properties[entry.getValue()] = properties.remove(old);
+        mapping[entry.getKey()] = entry.getValue();
+    }
+}
+for (entry in params.add.entrySet()) {
+    if (!mapping.containsKey(entry.getKey())) {
+        properties[entry.getValue()] = ctx._source._backup.remove(entry.getKey());
+        mapping[entry.getKey()] = entry.getValue();
+    }
+}
+"""
+
+# Failures kept as examples for each error type
+FAILURE_SAMPLES = getattr(settings, 'ONEGEO_FAILURE_SAMPLES', 10)
+# Directory where the details of every failure are written (None disables)
+FAILURES_DIR = getattr(settings, 'ONEGEO_FAILURES_DIR', None)
+
+# Item (or request) statuses meaning Elasticsearch is momentarily overloaded
+TRANSIENT_STATUSES = (429, 503)
+
 
 def elastic_exceptions_handler(f):
     @wraps(f)
@@ -52,199 +197,1061 @@ def elastic_exceptions_handler(f):
     return wrapper
 
 
+def generations_alias(alias):
+    """Return the alias of every index built for `alias`, live or former."""
+    return '{}-generations'.format(alias)
+
+
+def _queries_key(alias):
+    return 'onegeo_api:queries:{}'.format(alias)
+
+
+def remember_query(aliases, body=None, params=None):
+    """Keep a query among the latest ones of each of `aliases`, once in
+    a while (see `WARMUP_SAMPLE_RATE`)."""
+    if not WARMUP_RECENT_QUERIES or random.random() >= WARMUP_SAMPLE_RATE:
+        return
+    if isinstance(aliases, str):
+        aliases = aliases.split(',')
+    query = [body, params or {}]
+    try:
+        for alias in aliases:
+            key = _queries_key(alias)
+            queries = [q for q in cache.get(key, []) if q != query]
+            cache.set(
+                key, ([query] + queries)[:WARMUP_RECENT_QUERIES], None)
+    except Exception as e:
+        # Searches should not fail because of this
+        logger.warning('Unable to keep the query: {}'.format(e))
+
+
+def recent_queries(alias):
+    """Return the latest queries of `alias`, as `[body, params]`."""
+    if not WARMUP_RECENT_QUERIES:
+        return []
+    return cache.get(_queries_key(alias), [])
+
+
+def plan_index_settings(count=None, size=None, data_nodes=1, overrides=None):
+    """Return the settings of an index expected to hold `count` documents
+    weighing `size` bytes (None if unknown).
+
+    `overrides` (the `index_settings` of an `IndexProfile`) prevail.
+    """
+    index_settings = {
+        'number_of_replicas': max(min(REPLICAS, data_nodes - 1), 0)}
+
+    if size is not None:
+        # The number of shards is left to Elasticsearch when unknown
+        index_settings['number_of_shards'] = \
+            min(max(-(-size // SHARD_SIZE), 1), MAX_SHARDS)
+        index_settings['codec'] = \
+            size >= COMPRESSION_SIZE and 'best_compression' or 'default'
+        if size >= SLOW_REFRESH_SIZE:
+            index_settings['refresh_interval'] = SLOW_REFRESH_INTERVAL
+    else:
+        index_settings['codec'] = 'best_compression'
+
+    index_settings.update(overrides or {})
+    return index_settings
+
+
+def partition_of(md5, partitions):
+    """Return the partition a document falls in, given its `_md5`."""
+    return zlib.crc32(md5.encode()) % partitions
+
+
+def prepare_action(index, columns_mapping, md5, document):
+    """Return the encoded bulk action of a document, or an error."""
+    # Set by a step the document went through before, see `pdf`
+    error = document.pop('_error', None)
+    if error:
+        return None, error
+    header = {'index': {'_id': md5, '_index': index, '_type': index}}
+    document['_columns_mapping'] = columns_mapping
+    try:
+        chunk = BulkBody.encode(header, document)
+    except (TypeError, ValueError) as e:
+        return None, 'Unable to serialize document: {}'.format(e)
+    if len(chunk) > 104857600:
+        return None, 'File size exceed max limit.'
+    return chunk, None
+
+
+def prepare_actions(index, columns_mapping, documents):
+    """Encode a block of `(_id, document, position)` (in a child process)."""
+    return [prepare_action(index, columns_mapping, md5, document)
+            for md5, document, _ in documents]
+
+
+def iter_prepared(index, columns_mapping, documents, cursor=None, resume=0,
+                  processes=PREPARE_PROCESSES, chunk_size=PREPARE_CHUNK_SIZE):
+    """Yield `(_id, chunk, error, position)` for each of `documents`.
+
+    With `processes`, documents are encoded by blocks in a process pool.
+    """
+    def _documents():
+        for md5, document in documents:
+            position = cursor and cursor.position
+            if cursor and position <= resume:
+                continue
+            yield md5, document, position
+
+    if not processes:
+        for md5, document, position in _documents():
+            chunk, error = prepare_action(index, columns_mapping, md5, document)
+            yield md5, chunk, error, position
+        return
+
+    prepared = map_blocks(
+        prepare_actions, chunked(_documents(), chunk_size),
+        index, columns_mapping, processes=processes)
+    for block, actions in prepared:
+        for (md5, _, position), (chunk, error) in zip(block, actions):
+            yield md5, chunk, error, position
+
+
+class BulkBody(object):
+    """NDJSON body of a bulk request.
+
+    Each action is encoded once, so its size is the exact number of bytes
+    sent over the wire and the buffer goes to the transport as it is.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.chunks = []
+        self.size = 0
+        # Number of source documents consumed once this body is sent
+        self.position = None
+        # Number of actions coming from the retry queue
+        self.retried = 0
+        # Highest position to checkpoint while this body is not acknowledged
+        self.floor = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def encode(*lines):
+        chunk = bytearray()
+        for line in lines:
+            data = BULK_SERIALIZER(line)
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            chunk += data
+            chunk += b'\n'
+        return bytes(chunk)
+
+    def append(self, _id, chunk, floor=None):
+        self.ids.append(_id)
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        if floor is not None:
+            self.floor = floor if self.floor is None \
+                else min(self.floor, floor)
+
+    def getvalue(self):
+        return b''.join(self.chunks)
+
+
+class BulkThrottle(object):
+    """Adjust the bulk batch size to hold a target latency.
+
+    The size (both in documents and in bytes) grows or shrinks by the
+    ratio between the target and the observed latency, with at most
+    a factor of two per step, and is halved each time Elasticsearch
+    rejects items because its write queue is full.
+    """
+
+    def __init__(self, step, chunk_size, target_latency=BULK_TARGET_LATENCY,
+                 docs_range=BULK_DOCS_RANGE, bytes_range=BULK_BYTES_RANGE):
+        self.docs_range = docs_range
+        self.bytes_range = bytes_range
+        self.step = self._bound(step, docs_range)
+        self.chunk_size = self._bound(chunk_size, bytes_range)
+        self.target_latency = target_latency
+        self.history = []
+
+    @staticmethod
+    def _bound(value, bounds):
+        return int(min(max(value, bounds[0]), bounds[1]))
+
+    def update(self, stats):
+        self.history.append(
+            (stats['docs'], stats['bytes'], self.step, self.chunk_size))
+
+        if stats['rejected']:
+            factor = 0.5
+        else:
+            # `took` does not include the time spent queuing and
+            # transferring the request, so the largest one prevails.
+            latency = max(stats['elapsed'], stats['took'] / 1000)
+            factor = self.target_latency / max(latency, 0.001)
+            factor = min(max(factor, 0.5), 2)
+
+        self.step = self._bound(self.step * factor, self.docs_range)
+        self.chunk_size = self._bound(
+            self.chunk_size * factor, self.bytes_range)
+
+    def summary(self):
+        if not self.history:
+            return {}
+        docs, size, steps, chunk_sizes = zip(*self.history)
+        return {
+            'count': len(self.history),
+            'docs': {'min': min(docs), 'max': max(docs),
+                     'mean': sum(docs) // len(docs)},
+            'bytes': {'min': min(size), 'max': max(size),
+                      'mean': sum(size) // len(size)},
+            'step': {'min': min(steps), 'max': max(steps),
+                     'last': self.step},
+            'chunk_size': {'min': min(chunk_sizes), 'max': max(chunk_sizes),
+                           'last': self.chunk_size}}
+
+
+class RetryQueue(object):
+    """Hold temporarily rejected actions until they can be sent again.
+
+    Each action waits for an exponential backoff with full jitter, and is
+    given up once it has been rejected `max_retries` times.
+    """
+
+    def __init__(self, max_retries=BULK_MAX_RETRIES, backoff=BULK_BACKOFF):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.attempts = {}
+        self.heap = []
+        self.counter = itertools.count()
+        # Number of waiting actions by the floor of the body they came from
+        self.floors = Counter()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, _id, chunk, floor=None):
+        attempt = self.attempts.get(_id, 0) + 1
+        if attempt > self.max_retries:
+            return False
+        self.attempts[_id] = attempt
+        delay = random.uniform(
+            0, min(self.backoff[1], self.backoff[0] * 2 ** (attempt - 1)))
+        heapq.heappush(
+            self.heap,
+            (time.monotonic() + delay, next(self.counter), _id, chunk, floor))
+        if floor is not None:
+            self.floors[floor] += 1
+        return True
+
+    def floor(self):
+        """Return the lowest floor of the waiting actions, if any."""
+        return min(self.floors) if self.floors else None
+
+    def pop_due(self, limit=None):
+        now = time.monotonic()
+        while self.heap and self.heap[0][0] <= now:
+            if limit is not None:
+                if limit <= 0:
+                    break
+                limit -= 1
+            _, _, _id, chunk, floor = heapq.heappop(self.heap)
+            if floor is not None:
+                self.floors[floor] -= 1
+                if not self.floors[floor]:
+                    del self.floors[floor]
+            yield _id, chunk, floor
+
+    def wait(self):
+        if self.heap:
+            time.sleep(max(self.heap[0][0] - time.monotonic(), 0))
+
+
+class Failures(object):
+    """Count failed documents per error type, with a few examples of each.
+
+    Examples are drawn by reservoir sampling, so memory does not grow with
+    the number of failures. Given `spill`, the details of every failure
+    are also written to this gzip compressed NDJSON file.
+    """
+
+    def __init__(self, size=FAILURE_SAMPLES, spill=None):
+        self.size = size
+        self.count = 0
+        self.counts = Counter()
+        self.samples = {}
+        self.spill = spill
+        self.files = []
+        self._file = None
+        # Documents which failed (those with a md5 id)
+        self.ids = DigestSet()
+        # Whether documents failed which are not known (a shard failed)
+        self.incomplete = False
+
+    def __len__(self):
+        return self.count
+
+    def __iadd__(self, failures):
+        if failures is self:
+            return self
+        if isinstance(failures, Failures):
+            self.ids.update(failures.ids)
+            self.incomplete = self.incomplete or failures.incomplete
+            return self.update(failures.summary())
+        for failure in failures:
+            self.append(failure)
+        return self
+
+    @staticmethod
+    def error_type(error):
+        if isinstance(error, dict):
+            return str(error.get('type', 'unknown'))
+        return str(error).split(':', 1)[0][:100]
+
+    def append(self, failure):
+        """Add a failure, either `{_id: error}` or as reported by reindex
+        (that of a document, or that of a shard searched)."""
+        if 'cause' in failure and 'id' in failure:
+            _id, error = failure['id'], failure['cause']
+        elif 'shard' in failure:
+            _id = '{0}[{1}]'.format(failure.get('index'), failure['shard'])
+            error = failure.get('reason')
+            self.incomplete = True
+        else:
+            (_id, error), = failure.items()
+
+        try:
+            self.ids.add(_id)
+        except (TypeError, ValueError):
+            pass
+
+        kind = self.error_type(error)
+        self.count += 1
+        self.counts[kind] += 1
+        samples = self.samples.setdefault(kind, [])
+        if len(samples) < self.size:
+            samples.append({_id: error})
+        else:
+            i = random.randrange(self.counts[kind])
+            if i < self.size:
+                samples[i] = {_id: error}
+
+        if self.spill:
+            if self._file is None:
+                self._file = gzip.open(self.spill, 'at', encoding='utf-8')
+                self.files.append(self.spill)
+            self._file.write(json.dumps(
+                {'id': _id, 'type': kind, 'error': error}, default=str))
+            self._file.write('\n')
+
+    def update(self, summary):
+        """Merge a summary, from another task for instance."""
+        for kind, value in summary.get('types', {}).items():
+            # Each example stands for as many failures as it was drawn
+            # from, and is kept with a probability in proportion.
+            pool = []
+            for count, samples in (
+                    (self.counts[kind], self.samples.get(kind, [])),
+                    (value['count'], value['samples'])):
+                pool += [(sample, count / len(samples)) for sample in samples]
+            self.samples[kind] = [sample for sample, _ in heapq.nlargest(
+                self.size, pool, key=lambda x: random.random() ** (1 / x[1]))]
+            self.counts[kind] += value['count']
+        self.count += summary.get('count', 0)
+        self.files += summary.get('files', [])
+        return self
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def summary(self):
+        summary = {
+            'count': self.count,
+            'types': dict(
+                (kind, {'count': count, 'samples': self.samples[kind]})
+                for kind, count in self.counts.most_common())}
+        if self.files:
+            summary['files'] = self.files
+        return summary
+
+
+class BulkQueue(object):
+    """Run bulk requests in a thread pool and collect results in order.
+
+    `put` blocks as long as `queue_size` bodies are pending, which keeps
+    the producer (the collection iterator) from running ahead of
+    Elasticsearch.
+    """
+
+    def __init__(self, send, throttle=None, checkpoint=None, failures=None,
+                 thread_count=BULK_THREAD_COUNT, queue_size=BULK_QUEUE_SIZE):
+        self.send = send
+        self.throttle = throttle
+        self.checkpoint = checkpoint
+        self.thread_count = max(thread_count, 1)
+        self.queue_size = max(queue_size, self.thread_count)
+        self.retries = RetryQueue()
+        self.pending = deque()
+        self.created = DigestSet()
+        self.failed = Failures() if failures is None else failures
+        # Highest position acknowledged, and the last one checkpointed
+        self.position = None
+        self.checkpointed = None
+
+    def __enter__(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.thread_count)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type:
+            for future, _ in self.pending:
+                future.cancel()
+            self.pending.clear()
+        else:
+            self.join()
+        self.executor.shutdown(wait=True)
+
+    def put(self, body):
+        while len(self.pending) >= self.queue_size:
+            self._collect()
+        self.pending.append((self.executor.submit(self.send, body), body))
+
+    def new_body(self):
+        """Return an empty body, or one seeded with the due retries."""
+        body = BulkBody()
+        limit = self.throttle and self.throttle.step or None
+        for _id, chunk, floor in self.retries.pop_due(limit=limit):
+            body.append(_id, chunk, floor=floor)
+            body.retried += 1
+        return body
+
+    def join(self):
+        while True:
+            while self.pending:
+                self._collect()
+            if not self.retries:
+                break
+            self.retries.wait()
+            body = self.new_body()
+            if body:
+                self.put(body)
+
+    def _collect(self):
+        future, body = self.pending.popleft()
+        created, failed, retry, stats = future.result()
+        if self.throttle:
+            self.throttle.update(stats)
+        self.created.update(created)
+        self.failed += failed
+        for _id, chunk, error in retry:
+            if not self.retries.push(_id, chunk, floor=body.floor):
+                self.failed.append({_id: error})
+
+        if body.position is not None:
+            self.position = max(self.position or 0, body.position)
+        if callable(self.checkpoint) and self.position is not None:
+            # Every document up to the acknowledged position is indexed,
+            # but those still waiting to be sent again.
+            floors = [b.floor for _, b in self.pending if b.floor is not None]
+            if self.retries.floor() is not None:
+                floors.append(self.retries.floor())
+            position = min([self.position] + floors)
+            if position > (self.checkpointed or 0):
+                self.checkpointed = position
+                self.checkpoint(position)
+
+
+class AliasTopology(object):
+    """In-process copy of the aliases of every index.
+
+    It is read at once with a single request and kept for `ttl` seconds.
+    Changes made by this process are applied to the copy as they are
+    made; those made by others show once it expires.
+    """
+
+    def __init__(self, ttl=ALIASES_CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.aliases = None
+        self.loaded = 0
+
+    def get(self, fetch, fresh=False):
+        """Return a copy of the aliases by index, calling `fetch` if needed."""
+        with self.lock:
+            if fresh or self.aliases is None \
+                    or time.monotonic() - self.loaded > self.ttl:
+                self.aliases = dict(
+                    (index, set(value.get('aliases', {})))
+                    for index, value in fetch().items())
+                self.loaded = time.monotonic()
+            return dict(
+                (index, set(aliases)) for index, aliases in self.aliases.items())
+
+    def apply(self, actions):
+        with self.lock:
+            if self.aliases is None:
+                return
+            for action in actions:
+                (kind, value), = action.items()
+                if kind == 'add':
+                    self.aliases.setdefault(value['index'], set()).add(
+                        value['alias'])
+                elif kind == 'remove':
+                    self.aliases.get(value['index'], set()).discard(
+                        value['alias'])
+
+    def add_index(self, index):
+        with self.lock:
+            if self.aliases is not None:
+                self.aliases.setdefault(index, set())
+
+    def drop_indices(self, indices):
+        with self.lock:
+            if self.aliases is None:
+                return
+            for index in indices:
+                if index not in self.aliases:
+                    # Either an alias or a pattern, read everything again
+                    self.aliases = None
+                    return
+                del self.aliases[index]
+
+
 class ElasticWrapper(metaclass=Singleton):
 
     def __init__(self):
         self.conn = Elasticsearch(hosts=HOSTS)
+        self._remap_columns_script = False
+        self.topology = AliasTopology()
 
     def create_or_reindex(self, index=None, body=None, alias=None,
                           collection=None, columns_mapping=None,
-                          update=None, pipeline=False):
+                          update=None, pipeline=False, stats=None,
+                          bulk_load=BULK_LOAD, progress=None, manifest=None,
+                          checkpoint=None, resume=0, failures=None):
+        """Build `index` then make it the target of `alias`.
 
-        prev_indices = self.get_indices_by_alias(alias, unique=True)
-        if len(prev_indices) > 1:
-            raise Exception('TODO')
+        `manifest`, if given, lists the documents of the index currently
+        behind `alias` (see `IndexManifest`), and spares scanning it.
 
-        self.create_index(index, body)
+        `checkpoint` is called with the number of documents of the
+        collection consumed and acknowledged so far. Given this number
+        as `resume`, a later call continues the build of the same index.
 
-        created = []
-        failed = []
-        reindexed = []
+        Failures are accounted in `failures` (a `Failures`) if given.
+        """
 
-        docs = {}
+        prev_indices = self.get_indices_by_alias(
+            alias, unique=True, fresh=True)
+        if len(prev_indices) > 1:
+            raise Exception('TODO')
+        if index in prev_indices:
+            raise ValueError(
+                "Index '{}' is live, it cannot be built again.".format(index))
+
+        if bulk_load:
+            body, target_settings = self._bulk_load_body(body)
+        if resume and not self.is_index_exists(index=index):
+            resume = 0  # Nothing to resume
+        if not resume:
+            self.create_index(index, body)
+
+        created = DigestSet()
+        failed = Failures() if failures is None else failures
+        reindexed = DigestSet()
+
+        actual = None
         if len(prev_indices) == 1:
             prev_index = prev_indices[0]
-            docs = self.list_documents(index=prev_index)
+            actual = self._previous_documents(prev_index, manifest=manifest)
 
-        if docs:
-            actual = [
-                (dict(e[0]), list(m[0] for m in e[1]))
-                for e in itertools.groupby(
-                    docs[prev_index], key=operator.itemgetter(1))]
+        if actual is not None:
             try:
                 reindexed, _failed, created = \
                     self.reindex_collection(
                         prev_index, index, collection, actual,
-                        columns_mapping, update=update, pipeline=pipeline)
+                        columns_mapping, update=update, pipeline=pipeline,
+                        stats=stats, progress=progress, checkpoint=checkpoint,
+                        resume=resume, failures=failed)
             except Exception as e:
-                self.delete_index(index)
+                self.discard_index(index, alias)
                 raise e
             else:
                 failed += _failed
         else:
             try:
                 created, _failed = self.index_collection(
-                    index, collection, columns_mapping, pipeline=pipeline)
+                    index, collection, columns_mapping, pipeline=pipeline,
+                    stats=stats, checkpoint=checkpoint, resume=resume,
+                    failures=failed)
             except Exception as e:
-                self.delete_index(index)
+                self.discard_index(index, alias)
                 raise e
             else:
                 failed += _failed
 
+        try:
+            if bulk_load:
+                self.end_bulk_load(index, target_settings)
+            else:
+                self.merge_segments(index)
+            self.warm_up(index, alias)
+        except Exception as e:
+            self.discard_index(index, alias)
+            raise e
+
         self.switch_aliases(index, alias)
 
         return created, reindexed, failed
 
+    def _previous_documents(self, index, manifest=None):
+        """Iterate over the documents of `index` as `(_id, columns)`.
+
+        `columns` are the sorted items of the columns mapping of the
+        document. Return None if the index is empty.
+        """
+        if manifest and manifest.index == index:
+            if not manifest.count:
+                return None
+            columns = tuple(sorted(manifest.columns_mapping.items()))
+            return ((_id, columns) for _id in manifest.iter_ids())
+
+        if not self.count_documents(index):
+            return None
+        return (
+            (_id, tuple(sorted(source.get('_columns_mapping', {}).items())))
+            for _id, source in self.iter_documents(
+                index, _source='_columns_mapping'))
+
+    @elastic_exceptions_handler
+    def update_in_place(self, alias=None, collection=None, columns=None,
+                        columns_mapping=None, pipeline=False, stats=None,
+                        manifest=None, failures=None):
+        """Apply the changes of the collection to the index behind `alias`.
+
+        Documents added to the source are indexed and those removed from
+        it are deleted, in the live index. Return None (and do nothing)
+        when the index should be rebuilt instead, that is when there is
+        no live index or when its columns differ.
+        """
+        indices = self.get_indices_by_alias(alias, fresh=True)
+        if len(indices) != 1:
+            return None
+        index = indices[0]
+
+        res = self.conn.indices.get_mapping(index=index, doc_type=index)
+        meta = res[index]['mappings'].get(index, {}).get('_meta', {})
+        if meta.get('columns') != columns:
+            return None
+
+        prev_collection = DigestSet()
+        actual = self._previous_documents(index, manifest=manifest) or ()
+        for md5, prev_columns_mapping in actual:
+            if dict(prev_columns_mapping) != columns_mapping:
+                return None
+            prev_collection.add(md5)
+
+        created, failed, unchanged, removed = self._index_changes(
+            index, collection, prev_collection, columns_mapping,
+            pipeline=pipeline, stats=stats, failures=failures)
+
+        if removed:
+            self._delete_documents(index, removed, failures=failed)
+
+        self.conn.indices.refresh(index=index)
+
+        return index, created, unchanged, failed
+
+    @elastic_exceptions_handler
+    def create_index_for_build(self, index, body, bulk_load=BULK_LOAD):
+        """Create `index` to be built by `index_partition`.
+
+        Return the settings to pass to `complete_build`.
+        """
+        target_settings = None
+        if bulk_load:
+            body, target_settings = self._bulk_load_body(body)
+        self.create_index(index, body)
+        return target_settings
+
+    @elastic_exceptions_handler
+    def index_partition(self, index, collection, columns_mapping,
+                        partition=0, partitions=1, **kwargs):
+        """Index the documents of the `partition`-th of `partitions` parts.
+
+        Documents are dispatched by a hash of their `_md5`, so that a
+        given document always falls in the same partition. It stops as
+        soon as the index is deleted, the build being aborted.
+        """
+        documents = (
+            document for document in collection
+            if partition_of(document['_md5'], partitions) == partition)
+        return self.index_collection(
+            index, documents, columns_mapping, guard=True, **kwargs)
+
+    @elastic_exceptions_handler
+    def complete_build(self, index, alias, target_settings=None, count=None):
+        """Check the index built then make it the target of `alias`."""
+        if target_settings is not None:
+            self.end_bulk_load(index, target_settings)
+        else:
+            self.merge_segments(index)
+
+        if count is not None:
+            actual = self.count_documents(index)
+            if actual != count:
+                raise ElasticError(
+                    "Index '{0}' contains {1} documents, {2} expected.".format(
+                        index, actual, count))
+
+        self.warm_up(index, alias)
+        self.switch_aliases(index, alias)
+
     @elastic_exceptions_handler
     def create_index(self, index, body):
         self.conn.indices.create(index=index, body=body)
+        self.topology.add_index(index)
+
+    def _bulk_load_body(self, body):
+        """Return `body` with the bulk-load settings.
+
+        Then the settings to restore once the documents are loaded.
+        """
+        body = dict(body or {})
+        index_settings = dict(body.get('settings', {}))
+
+        target_settings = {}
+        for key, value in BULK_LOAD_SETTINGS.items():
+            # Settings could be given with or without the 'index.' prefix
+            for name in (key, 'index.{}'.format(key)):
+                if name in index_settings:
+                    target_settings[key] = index_settings.pop(name)
+            # `None` resets the setting to its default value
+            target_settings.setdefault(key, None)
+            index_settings[key] = value
+
+        body['settings'] = index_settings
+        return body, target_settings
 
     @elastic_exceptions_handler
-    def reindex_collection(self, prev_index, next_index, collection,
-                           actual, columns_mapping, step=1000,
-                           chunk_size=10485760, update=False, pipeline=False):
-
-        painless = []
-        REPLACE_COLUMN = (
-            'ctx._source.properties["{new}"]=ctx._source.properties.remove("{old}");'
-            'ctx._source._columns_mapping["{raw}"]="{new}"')
-        ADD_COLUMN = (
-            'ctx._source.properties["{new}"]=ctx._source._backup.remove("{raw}");'
-            'ctx._source._columns_mapping["{raw}"]="{new}"')
-        REMOVE_COLUMN = (
-            'ctx._source.properties.remove("{old}");'
-            'ctx._source._columns_mapping.remove("{raw}")')
-
-        prev_collection = []
-        for prev_columns_mapping, prev_docs in actual:
-
-            left = set()
-            right = set()
-            gc.collect(generation=2)
-
-            prev_collection += prev_docs
-            if prev_columns_mapping != columns_mapping:
-
-                left = set(prev_columns_mapping) - set(columns_mapping)
-                right = set(columns_mapping) - set(prev_columns_mapping)
-                intersect = set.intersection(
-                    set(prev_columns_mapping), set(columns_mapping))
-
-                if intersect:
-                    for raw in intersect:
-                        new = columns_mapping[raw]
-                        old = prev_columns_mapping.get(raw)
-                        if old and new != old:
-                            painless.append(
-                                REPLACE_COLUMN.format(
-                                    new=new, old=old, raw=raw))
-                if left:
-                    for raw in left:
-                        painless.append(
-                            REMOVE_COLUMN.format(
-                                old=prev_columns_mapping[raw], raw=raw))
-                if right:
-                    for raw in right:
-                        painless.append(
-                            ADD_COLUMN.format(
-                                new=columns_mapping[raw], raw=raw))
-
-        to_reindex = []
-        created = []
-        failed = []
+    def end_bulk_load(self, index, target_settings):
+        # Merged before the replicas are allocated, which then copy
+        # the merged segments instead of merging them again.
+        self.merge_segments(index)
+        self.conn.indices.put_settings(
+            index=index, body={'index': target_settings})
+        res = self.conn.cluster.health(
+            index=index, wait_for_status='green',
+            timeout=BULK_LOAD_HEALTH_TIMEOUT)
+        if res.get('timed_out'):
+            # Replicas may never be allocated (on a single node cluster for
+            # instance), so the primary shards being active is sufficient.
+            logger.warning(
+                "Index '{0}' is still {1} after {2}.".format(
+                    index, res.get('status'), BULK_LOAD_HEALTH_TIMEOUT))
+            self.conn.cluster.health(
+                index=index, wait_for_status='yellow',
+                timeout=BULK_LOAD_HEALTH_TIMEOUT)
 
-        if update:
+    @elastic_exceptions_handler
+    def merge_segments(self, index):
+        """Refresh `index` then merge it down to `WARMUP_SEGMENTS`."""
+        self.conn.indices.refresh(index=index)
+        if not WARMUP_SEGMENTS:
+            return
+        try:
+            self.conn.indices.forcemerge(
+                index=index, max_num_segments=WARMUP_SEGMENTS,
+                request_timeout=WARMUP_TIMEOUT)
+        except exceptions.ConnectionTimeout:
+            logger.warning(
+                "Index '{0}' is still being merged after {1} seconds.".format(
+                    index, WARMUP_TIMEOUT))
+
+    def warm_up(self, index, alias):
+        """Run the configured and the recent queries of `alias` (and of the
+        other aliases of its live index) on `index`.
+
+        Failing queries are only logged, the index being searchable anyway.
+        """
+        # Searches also go through the aliases of the search models
+        aliases = {alias}
+        for live in self.get_indices_by_alias(alias):
+            aliases.update(self.get_aliases_by_index(live))
+        aliases.discard(generations_alias(alias))
+
+        queries = [[body, {}] for body in WARMUP_QUERIES]
+        for name in sorted(aliases):
+            queries += [q for q in recent_queries(name) if q not in queries]
+        for body, params in queries:
+            try:
+                self.conn.search(index=index, body=body, params=params)
+            except exceptions.TransportError as e:
+                logger.warning(
+                    "Warm-up query failed on index '{0}': {1}".format(
+                        index, e))
 
-            body = []
-            body_size = 0
-            # count = 0
-            for document in collection:
-                # count += 1
-                # if count > 5000:
-                #     break
+    @elastic_exceptions_handler
+    def rename_columns(self, alias, columns, columns_mapping):
+        """Rename the columns of the live index with `alias` type fields.
+
+        Documents are left untouched. Return False (and do nothing) unless
+        the change is a mere renaming of columns, which is determined from
+        the `_meta` stored in the mapping of the live index.
+        """
+        indices = self.get_indices_by_alias(alias, fresh=True)
+        if len(indices) != 1:
+            return False
+        index = indices[0]
+
+        res = self.conn.indices.get_mapping(index=index, doc_type=index)
+        mapping = res[index]['mappings'].get(index, {})
+        meta = mapping.get('_meta', {})
+
+        prev_columns = meta.get('columns')
+        # Names of the columns as they are in the documents
+        physical = meta.get('columns_mapping')
+        if not prev_columns or not physical \
+                or prev_columns == columns \
+                or set(physical) != set(columns_mapping):
+            return False
+
+        def _without_alias(columns):
+            return dict(
+                (col['name'], dict(
+                    (k, v) for k, v in col.items() if k != 'alias'))
+                for col in columns)
+
+        if _without_alias(prev_columns) != _without_alias(columns):
+            return False
+
+        fields = mapping.get('properties', {}).get(
+            'properties', {}).get('properties', {})
+
+        new_fields = {}
+        for raw, new in columns_mapping.items():
+            path = 'properties.{}'.format(physical[raw])
+            if new == physical[raw] or fields.get(new, {}).get('path') == path:
+                continue
+            if new in fields or new in new_fields:
+                return False  # Name already in use
+            new_fields[new] = {'type': 'alias', 'path': path}
 
+        try:
+            self.conn.indices.put_mapping(
+                index=index, doc_type=index, body={
+                    '_meta': dict(meta, columns=columns),
+                    'properties': {
+                        'properties': {'properties': new_fields}}})
+        except exceptions.RequestError as e:
+            # `alias` fields require Elasticsearch 6.4, the index is
+            # rebuilt instead
+            logger.warning(
+                "Unable to rename the columns of index '{0}': {1}".format(
+                    index, e))
+            return False
+        return True
+
+    @elastic_exceptions_handler
+    def reindex_collection(self, prev_index, next_index, collection,
+                           actual, columns_mapping, step=1000,
+                           chunk_size=10485760, update=False, pipeline=False,
+                           stats=None, async_reindex=ASYNC_REINDEX,
+                           progress=None, checkpoint=None, resume=0,
+                           failures=None):
+
+        prev_collection = DigestSet()
+        prev_columns_mappings = set()
+        for md5, prev_columns_mapping in actual:
+            prev_collection.add(md5)
+            prev_columns_mappings.add(prev_columns_mapping)
+
+        rename = {}
+        add = {}
+        remove = set()
+        for prev_columns_mapping in map(dict, prev_columns_mappings):
+            if prev_columns_mapping == columns_mapping:
+                continue
+            for raw, new in columns_mapping.items():
+                old = prev_columns_mapping.get(raw)
+                if old is None:
+                    add[raw] = new
+                elif old != new:
+                    rename[raw] = new
+            remove.update(set(prev_columns_mapping) - set(columns_mapping))
+
+        script = None
+        if rename or add or remove:
+            script = {
+                'id': self.put_remap_columns_script(),
+                'params': {
+                    'rename': rename, 'add': add, 'remove': sorted(remove)}}
+
+        to_reindex = DigestSet()
+        created = DigestSet()
+        failed = Failures() if failures is None else failures
+
+        if not async_reindex:
+            if update:
+                created, failed, to_reindex, removed = self._index_changes(
+                    next_index, collection, prev_collection, columns_mapping,
+                    pipeline=pipeline, step=step, chunk_size=chunk_size,
+                    stats=stats, checkpoint=checkpoint, resume=resume,
+                    failures=failed)
+            else:
+                to_reindex = prev_collection
+            self._reindex_by_ids(
+                prev_index, next_index, to_reindex, script, step=step,
+                failures=failed)
+            return to_reindex, failed, created
+
+        # The whole previous index is copied by a single server-side task,
+        # while the new documents (if any) are being indexed. Then the
+        # documents removed from the source are deleted from the copy.
+        task_id = self._start_reindex(prev_index, next_index, script)
+        if callable(progress):
+            # Known to the caller, who may have to cancel it (see `cancel_task`)
+            progress({'task': task_id})
+        try:
+            if update:
+                created, failed, to_reindex, removed = self._index_changes(
+                    next_index, collection, prev_collection, columns_mapping,
+                    pipeline=pipeline, step=step, chunk_size=chunk_size,
+                    stats=stats, checkpoint=checkpoint, resume=resume,
+                    failures=failed)
+            else:
+                to_reindex, removed = prev_collection, DigestSet()
+            failed += self._wait_for_reindex(task_id, progress=progress)
+        except Exception as e:
+            self.conn.tasks.cancel(task_id=task_id, ignore=(404,))
+            raise e
+
+        if removed:
+            self._delete_documents(next_index, removed, failures=failed)
+
+        return to_reindex, failed, created
+
+    def put_remap_columns_script(self):
+        """Store the column remapping script, once per process."""
+        if not self._remap_columns_script:
+            self.conn.put_script(
+                id=REMAP_COLUMNS_SCRIPT_ID,
+                body={'script': {
+                    'lang': 'painless', 'source': REMAP_COLUMNS_SCRIPT}})
+            self._remap_columns_script = True
+        return REMAP_COLUMNS_SCRIPT_ID
+
+    def _index_changes(self, index, collection, prev_collection,
+                       columns_mapping, stats=None, **kwargs):
+        """Index the documents missing from `prev_collection`.
+
+        Return the created and failed documents, then the ids found
+        in both the collection and `prev_collection` (unchanged), and
+        those found in `prev_collection` only (removed).
+        """
+        unchanged = DigestSet()
+
+        collection = Prefetcher(collection, maxsize=PREFETCH_SIZE)
+        cursor = Cursor(collection)
+
+        def _documents():
+            for document in cursor:
                 md5 = document.get('_md5')
                 if md5 in prev_collection:
-                    to_reindex.append(md5)
+                    unchanged.add(md5)
                 else:
+                    yield md5, document
 
-                    header = {'index': {'_id': md5, '_index': next_index, '_type': next_index}}
-                    document['_columns_mapping'] = columns_mapping
-                    doc = [header, document]
-
-                    try:
-                        doc_size = estimate_size(doc)
-                    except RecursionError:
-                        failed.append({md5: 'Unable to estimate size.'})
-                        continue
-                    if doc_size > 104857600:
-                        failed.append({md5: 'File size exceed max limit.'})
-                        continue
-
-                    x = len(body) / 2
-                    reload = x == step
-                    one_bullet_left = body_size + doc_size > chunk_size
-
-                    if one_bullet_left or reload:
-                        self._bulk(
-                            next_index, next_index, body, pipeline,
-                            created=lambda z: created.append(z),
-                            failed=lambda z: failed.append(z))
-                        body, body_size = doc, doc_size
-                        continue
-
-                    body += doc
-                    body_size += doc_size
+        created, failed = self._index_documents(
+            index, _documents(), columns_mapping,
+            stats=stats, cursor=cursor, **kwargs)
 
-            if body:
-                self._bulk(
-                    next_index, next_index, body, pipeline,
-                    created=lambda z: created.append(z),
-                    failed=lambda z: failed.append(z))
+        # Whatever is left once the collection is consumed
+        # has been removed from the source.
+        removed = prev_collection - unchanged
 
-        else:
-            to_reindex = prev_collection
-
-        count = len(to_reindex)
-        if count:
-            x = 0
-            for i in range(0, count - 1, step):
-                y = (count > i) and i < step and i or step + i
-                body = {
-                    'size': len(to_reindex[x:y]),
-                    'source': {
-                        'index': prev_index,
-                        'type': prev_index,
-                        'query': {
-                            'ids': {
-                                'type': prev_index,
-                                'values': to_reindex[x:y]}}},
-                    'dest': {
-                        'index': next_index,
-                        'type': next_index,
-                        'version_type': 'internal'}}
-
-                if painless:
-                    body['script'] = {
-                        'source': ';'.join(painless),
-                        'lang': 'painless'}
-
-                res = self.conn.reindex(body)
-                # TODO parse res
-                failed += res.get('failure', [])
-                x += step
-
-        return list(to_reindex), failed, created
+        if stats is not None:
+            stats['removed'] = len(removed)
+            stats['prefetch'] = collection.summary()
+
+        return created, failed, unchanged, removed
+
+    def _reindex_by_ids(self, prev_index, next_index, ids, script, step=1000,
+                        failures=None):
+        failed = Failures() if failures is None else failures
+        for values in chunked(ids, step):
+            body = {
+                'source': {
+                    'index': prev_index,
+                    'type': prev_index,
+                    'size': step,
+                    'query': {
+                        'ids': {
+                            'type': prev_index,
+                            'values': values}}},
+                'dest': {
+                    'index': next_index,
+                    'type': next_index,
+                    'version_type': 'internal'}}
+            if script:
+                body['script'] = script
+
+            res = self.conn.reindex(body)
+            failed += res.get('failures', [])
+        return failed
+
+    def _start_reindex(self, prev_index, next_index, script):
+        body = {
+            'source': {
+                'index': prev_index,
+                'type': prev_index,
+                'size': REINDEX_BATCH_SIZE},
+            'dest': {
+                'index': next_index,
+                'type': next_index,
+                'version_type': 'internal'}}
+        if script:
+            body['script'] = script
+
+        res = self.conn.reindex(
+            body, slices='auto', wait_for_completion=False)
+        return res['task']
+
+    def _wait_for_reindex(self, task_id, progress=None):
+        while True:
+            res = self.conn.tasks.get(task_id=task_id)
+            status = res['task'].get('status', {})
+            if callable(progress):
+                progress(dict(
+                    ((k, status.get(k)) for k in REINDEX_PROGRESS_KEYS),
+                    task=task_id))
+            if res.get('completed'):
+                break
+            time.sleep(REINDEX_POLL_INTERVAL)
+
+        if 'error' in res:
+            raise ElasticError(
+                'Reindex task {0} failed: {1}.'.format(
+                    task_id, res['error'].get('reason')),
+                details=res['error'])
+        return res.get('response', {}).get('failures', [])
+
+    def _delete_documents(self, index, ids, failures=None):
+        queue = BulkQueue(
+            lambda body: self._bulk(index, index, body, False),
+            failures=failures)
+        with queue:
+            body = BulkBody()
+            for _id in ids:
+                header = {'delete': {'_id': _id, '_index': index, '_type': index}}
+                if len(body) >= REINDEX_BATCH_SIZE:
+                    queue.put(body)
+                    body = queue.new_body()
+                body.append(_id, BulkBody.encode(header))
+            if body:
+                queue.put(body)
+        return queue.created, queue.failed
 
     # @elastic_exceptions_handler
     # def index_collection(self, index, collection, columns_mapping, pipeline=False):
@@ -271,76 +1278,125 @@ class ElasticWrapper(metaclass=Singleton):
     #         max_retries=2, initial_backoff=2, stats_only=False,
     #         max_backoff=600, yield_ok=True)
 
-    def _bulk(self, index, doc_type, body, pipeline, created=None, failed=None):
-        try:
-            res = self.conn.bulk(
-                index=index, doc_type=doc_type, body=body,
-                pipeline=pipeline and 'attachment' or None)
-        except exceptions.SerializationError as e:
-            print(e)
-            return
-        except ValueError as e:
-            print(e)
-            return
-        for item in res.get('items'):
-            md5 = item['index']['_id']
-            error = item['index'].get('error')
-            if error:
-                callable(failed) and failed({md5: error})
-            else:
-                callable(created) and created(md5)
-
-    @elastic_exceptions_handler
-    def index_collection(self, index, collection, columns_mapping,
-                         pipeline=False, step=100, chunk_size=10485760):
+    def _bulk(self, index, doc_type, body, pipeline):
         created = []
         failed = []
-        body = []
-        body_size = 0
-        # count = 0
-
-        for document in collection:
-            # count += 1
-            # if count > 5000:
-            #     break
+        retry = []
+        stats = {'docs': len(body), 'bytes': body.size,
+                 'elapsed': 0, 'took': 0, 'rejected': 0}
+        params = pipeline and {'pipeline': 'attachment'} or {}
+        start = time.monotonic()
+        try:
+            # The body is already NDJSON encoded, thus the transport
+            # is called directly to spare a second serialization.
+            res = self.conn.transport.perform_request(
+                'POST', _make_path(index, doc_type, '_bulk'),
+                params=params, body=body.getvalue(),
+                headers={'content-type': 'application/x-ndjson'})
+        except (exceptions.SerializationError, ValueError) as e:
+            failed = [{_id: str(e)} for _id in body.ids]
+            return created, failed, retry, stats
+        except exceptions.TransportError as e:
+            if not isinstance(e, exceptions.ConnectionError) \
+                    and e.status_code not in TRANSIENT_STATUSES:
+                raise e
+            stats['rejected'] = len(body)
+            retry = list(zip(body.ids, body.chunks, itertools.repeat(str(e))))
+            return created, failed, retry, stats
+
+        stats['elapsed'] = time.monotonic() - start
+        stats['took'] = res.get('took', 0)
+        for i, item in enumerate(res.get('items')):
+            # Either an 'index' or a 'delete' action
+            item = next(iter(item.values()))
+            md5 = item['_id']
+            error = item.get('error')
+            if not error:
+                created.append(md5)
+            elif item.get('status') in TRANSIENT_STATUSES or \
+                    error.get('type') == 'es_rejected_execution_exception':
+                stats['rejected'] += 1
+                retry.append((md5, body.chunks[i], error))
+            else:
+                failed.append({md5: error})
+        return created, failed, retry, stats
+
+    def _index_documents(self, index, documents, columns_mapping,
+                         pipeline=False, step=100, chunk_size=10485760,
+                         stats=None, cursor=None, checkpoint=None, resume=0,
+                         failures=None, guard=False):
+        """Index the `(_id, document)` pairs of `documents`.
+
+        `cursor` is the `Cursor` over the collection the documents come
+        from. Documents at or before the `resume` position are skipped.
+        With `guard`, indexing stops once the index has been deleted.
+        """
+        def send(body):
+            # A bulk request would create the deleted index again
+            if guard and not self.conn.indices.exists(index=index):
+                raise ElasticError(
+                    "Index '{}' no longer exists.".format(index),
+                    status_code=404, details=None)
+            return self._bulk(index, index, body, pipeline)
+
+        throttle = BulkThrottle(step, chunk_size)
+        queue = BulkQueue(
+            send, throttle=throttle, checkpoint=cursor and checkpoint,
+            failures=failures)
+
+        with queue:
+            body = BulkBody()
+            prepared = iter_prepared(
+                index, columns_mapping, documents,
+                cursor=cursor, resume=resume)
+            for md5, chunk, error, position in prepared:
+                if error:
+                    queue.failed.append({md5: error})
+                    continue
+                doc_size = len(chunk)
+
+                reload = len(body) >= throttle.step
+                one_bullet_left = body.size + doc_size > throttle.chunk_size
+
+                if body and (one_bullet_left or reload):
+                    # The current document goes to the next body
+                    body.position = cursor and position - 1
+                    queue.put(body)
+                    body = queue.new_body()
+
+                body.append(md5, chunk, floor=cursor and position - 1)
 
-            md5 = document.pop('_md5')
-            header = {'index': {'_id': md5, '_index': index, '_type': index}}
-            document['_columns_mapping'] = columns_mapping
-            doc = [header, document]
+            if body:
+                body.position = cursor and cursor.position
+                queue.put(body)
 
-            try:
-                doc_size = estimate_size(doc)
-            except RecursionError:
-                failed.append({md5: 'Unable to estimate size.'})
-                continue
-            if doc_size > 104857600:
-                failed.append({md5: 'File size exceed max limit.'})
-                continue
+        if stats is not None:
+            stats['batches'] = throttle.summary()
+            if resume:
+                stats['resumed'] = resume
 
-            x = len(body) / 2
-            reload = x == step
-            one_bullet_left = body_size + doc_size > chunk_size
+        return queue.created, queue.failed
 
-            if one_bullet_left or reload:
-                self._bulk(
-                    index, index, body, pipeline,
-                    created=lambda z: created.append(z),
-                    failed=lambda z: failed.append(z))
-                body, body_size = doc, doc_size
-                continue
+    @elastic_exceptions_handler
+    def index_collection(self, index, collection, columns_mapping,
+                         pipeline=False, step=100, chunk_size=10485760,
+                         stats=None, checkpoint=None, resume=0, failures=None,
+                         guard=False):
 
-            body += doc
-            body_size += doc_size
+        collection = Prefetcher(collection, maxsize=PREFETCH_SIZE)
+        cursor = Cursor(collection)
+        documents = (
+            (document.pop('_md5'), document) for document in cursor)
 
-        # else:
-        if body:
-            self._bulk(
-                index, index, body, pipeline,
-                created=lambda z: created.append(z),
-                failed=lambda z: failed.append(z))
+        res = self._index_documents(
+            index, documents, columns_mapping, pipeline=pipeline,
+            step=step, chunk_size=chunk_size, stats=stats,
+            cursor=cursor, checkpoint=checkpoint, resume=resume,
+            failures=failures, guard=guard)
 
-        return created, failed
+        if stats is not None:
+            stats['prefetch'] = collection.summary()
+        return res
 
     @elastic_exceptions_handler
     def is_index_exists(self, **kwargs):
@@ -354,117 +1410,287 @@ class ElasticWrapper(metaclass=Singleton):
     @elastic_exceptions_handler
     def delete_index(self, index, **kwargs):
         self.conn.indices.delete(index=index, **kwargs)
+        self.topology.drop_indices(
+            isinstance(index, str) and index.split(',') or index)
+
+    def discard_index(self, index, alias):
+        """Delete `index`, built for `alias`, unless it has gone live."""
+        if index in self.get_indices_by_alias(alias, fresh=True):
+            logger.warning(
+                "Index '{0}' is behind '{1}', it is not deleted.".format(
+                    index, alias))
+            return False
+        if self.is_index_exists(index=index):
+            self.delete_index(index)
+        return True
+
+    def delete_indices_later(self, indices):
+        """Delete `indices` from a background thread."""
+        def _delete():
+            try:
+                self.delete_index(indices)
+            except ElasticError as e:
+                logger.warning('Unable to delete indices {0}: {1}'.format(
+                    ', '.join(indices), e))
+
+        # Not a daemon, so that the process waits for it before exiting
+        threading.Thread(target=_delete).start()
 
     @elastic_exceptions_handler
-    def switch_aliases(self, index, name):
+    def switch_aliases(self, index, name, keep=KEEP_GENERATIONS):
+        """Move `name`, and the other aliases of its indices, to `index`.
+
+        Aliases are swapped at once. Then the `keep` latest former indices
+        are retired (see `retire_indices`) and the others are deleted in
+        the background.
+        """
+        generations = generations_alias(name)
+        aliases = self.topology.get(self.conn.indices.get_alias, fresh=True)
+        indices = [i for i, names in aliases.items()
+                   if name in names and i != index]
+
         body = {'actions': []}
-        indices = self.get_indices_by_alias(name)
-        for old_index in iter(indices):
-            prev_aliases = self.get_aliases_by_index(old_index)
-            for prev_alias in prev_aliases:
+        for old_index in indices:
+            for prev_alias in sorted(aliases[old_index]):
+                if prev_alias == generations:
+                    continue
                 if prev_alias != name:
                     body['actions'].append(
                         {'add': {'index': index, 'alias': prev_alias}})
+                body['actions'].append(
+                    {'remove': {'index': old_index, 'alias': prev_alias}})
+            # Those built before generations were kept lack the alias
             body['actions'].append(
-                {'remove': {'index': old_index, 'alias': name}})
-
-        self.conn.indices.put_alias(index=index, name=name)
+                {'add': {'index': old_index, 'alias': generations}})
         body['actions'].append(
             {'add': {'index': index, 'alias': name}})
+        body['actions'].append(
+            {'add': {'index': index, 'alias': generations}})
 
         self.update_aliases(body)
-        for i in range(len(indices)):
-            self.delete_index(indices[i])
+
+        previous = self.list_generations(name)
+        retired = [i for i in previous[:keep] if i in indices]
+        if retired:
+            self.retire_indices(retired)
+        if previous[keep:]:
+            self.delete_indices_later(previous[keep:])
 
     @elastic_exceptions_handler
-    def get_indices_by_alias(self, name, unique=False):
-        indices = []
-        if self.conn.indices.exists_alias(name=name):
-            res = self.conn.indices.get_alias(name=name)
-            for index, _ in res.items():
-                indices.append(index)
+    def list_generations(self, alias):
+        """Return the former indices of `alias`, the latest first."""
+        aliases = self.topology.get(self.conn.indices.get_alias)
+        generations = generations_alias(alias)
+        indices = set(i for i, names in aliases.items()
+                      if generations in names and alias not in names)
+        if not indices:
+            return []
+        res = self.conn.indices.get_settings(
+            index=','.join(sorted(indices)), name='index.creation_date',
+            flat_settings=True)
+        return sorted(
+            indices, reverse=True,
+            key=lambda i: int(res.get(i, {}).get('settings', {}).get(
+                'index.creation_date', 0)))
+
+    @elastic_exceptions_handler
+    def retire_indices(self, indices):
+        """Keep former `indices` at little cost, closed or without replicas."""
+        if CLOSE_GENERATIONS:
+            self.conn.indices.close(index=','.join(indices))
+        else:
+            self.conn.indices.put_settings(
+                index=','.join(indices),
+                body={'index': {'number_of_replicas': 0}})
+
+    @elastic_exceptions_handler
+    def rollback(self, alias, index=None, number_of_replicas=None):
+        """Make a former index (the latest by default) the target of `alias`.
+
+        The live index is retired in turn, so the rollback can be undone.
+        """
+        generations = self.list_generations(alias)
+        if not generations:
+            raise ElasticError(
+                "There is no former index of '{}'.".format(alias),
+                status_code=404, details=None)
+        index = index or generations[0]
+        if index not in generations:
+            raise ElasticError(
+                "'{0}' is not a former index of '{1}'.".format(index, alias),
+                status_code=404, details=None)
+
+        if CLOSE_GENERATIONS:
+            self.conn.indices.open(index=index)
+        if number_of_replicas is not None:
+            self.conn.indices.put_settings(
+                index=index,
+                body={'index': {'number_of_replicas': number_of_replicas}})
+        # Searchable as soon as its primary shards are
+        self.conn.cluster.health(
+            index=index, wait_for_status='yellow',
+            timeout=BULK_LOAD_HEALTH_TIMEOUT)
+
+        self.switch_aliases(index, alias, keep=max(KEEP_GENERATIONS, 1))
+        return index
+
+    @elastic_exceptions_handler
+    def get_indices_by_alias(self, name, unique=False, fresh=False):
+        """Return the indices behind alias `name`.
+
+        Read from the in-process copy of the aliases unless `fresh`.
+        """
+        name = str(name)
+        aliases = self.topology.get(self.conn.indices.get_alias, fresh=fresh)
+        indices = sorted(i for i, names in aliases.items() if name in names)
         if unique and len(indices) > 1:
             raise Exception('Index should be unique.')  # TODO
         return indices
 
     @elastic_exceptions_handler
-    def get_aliases_by_index(self, index):
-        aliases = []
-        if self.conn.indices.exists(index=index):
-            res = self.conn.indices.get_alias(index=index)
-            for alias, _ in res[index]['aliases'].items():
-                aliases.append(alias)
-        return aliases
+    def get_aliases_by_index(self, index, fresh=False):
+        aliases = self.topology.get(self.conn.indices.get_alias, fresh=fresh)
+        return sorted(aliases.get(index, ()))
 
     @elastic_exceptions_handler
     def update_aliases(self, body):
         self.conn.indices.update_aliases(body=body)
+        self.topology.apply(body.get('actions', []))
 
     @elastic_exceptions_handler
-    def search(self, index='_all', body=None, params={}):
-        return self.conn.search(index=index, body=body, params=params)
+    def put_search_aliases(self, members):
+        """Point each alias of `members` at the live indices of the aliases
+        it is mapped to (those of indexation profiles), and only at them."""
+        aliases = self.topology.get(self.conn.indices.get_alias, fresh=True)
+        body = {'actions': []}
+        for name, targets in sorted(members.items()):
+            targets = set(targets)
+            for index, names in sorted(aliases.items()):
+                if not names.isdisjoint(targets):
+                    if name not in names:
+                        body['actions'].append(
+                            {'add': {'index': index, 'alias': name}})
+                elif name in names:
+                    body['actions'].append(
+                        {'remove': {'index': index, 'alias': name}})
+        if body['actions']:
+            self.update_aliases(body)
 
     @elastic_exceptions_handler
-    def list_documents(self, index, step=1000, **kwargs):
-
-        x = 0
-        l = []
-        search_after = None
-        count = self.conn.count(index=index).get('count')
-        for i in range(0, count - 1, step):
-            y = (count > i) and i < step and i or step
-            body = {
-                '_source': '_columns_mapping',
-                'query': {'match_all': {}},
-                'size': y,
-                'sort': {'_id': 'asc'},
-                'stored_fields': []}
-
-            if x < 10000:
-                body['from'] = x
-            else:
-                body['search_after'] = [search_after]
+    def search(self, index='_all', body=None, params={}):
+        res = self.conn.search(index=index, body=body, params=params)
+        if index != '_all':
+            remember_query(index, body=body, params=params)
+        return res
 
-            res = self.conn.search(index=index, body=body)
-            l += [(
-                hit['_index'],
-                hit['_id'],
-                tuple(sorted([(k, v) for k, v in hit['_source'].get('_columns_mapping', {}).items()]))
-                ) for hit in res['hits']['hits']]
+    @elastic_exceptions_handler
+    def estimate_volume(self, alias, sample_size=1000):
+        """Return the number of documents of the index behind `alias` and
+        their size (in bytes, as JSON) extrapolated from `sample_size` of
+        them, or None.
+
+        The size is that of the documents rather than that of the store,
+        whose compression depends on the settings of the index.
+        """
+        indices = self.get_indices_by_alias(alias)
+        if len(indices) != 1 or not sample_size:
+            return None
+        count = self.count_documents(indices[0])
+        if not count:
+            return None
+        res = self.conn.search(
+            index=indices[0], body={'query': {'match_all': {}}},
+            size=sample_size)
+        hits = res['hits']['hits']
+        size = sum(len(json_dumps(hit['_source'])) for hit in hits)
+        return count, size * count // max(len(hits), 1)
 
-            x += step
-            search_after = l[-1][1]
+    @elastic_exceptions_handler
+    def cancel_task(self, task_id, timeout='60s'):
+        """Cancel a task of the cluster, then wait for it to end."""
+        self.conn.tasks.cancel(task_id=task_id, ignore=(404,))
+        try:
+            self.conn.tasks.get(
+                task_id=task_id, wait_for_completion=True, timeout=timeout,
+                ignore=(404,))
+        except exceptions.TransportError as e:
+            logger.warning(
+                "Task '{0}' may still be running: {1}".format(task_id, e))
 
-        groups = itertools.groupby(
-            sorted(l, key=operator.itemgetter(0)), key=operator.itemgetter(0))
+    @elastic_exceptions_handler
+    def count_data_nodes(self):
+        return self.conn.cluster.health().get('number_of_data_nodes', 1)
 
-        return dict((g[0], [(m[1], m[2]) for m in tuple(g[1])]) for g in groups)
+    @elastic_exceptions_handler
+    def count_documents(self, index):
+        return self.conn.count(index=index).get('count')
 
     @elastic_exceptions_handler
-    def get_all_documents(self, index, step=1000, **kwargs):
-        _source = kwargs.pop('_source', [])
-
-        x = 0
-        search_after = None
-        count = self.conn.count(index=index).get('count')
-        for i in range(0, count - 1, step):
-            y = (count > i) and i < step and i or step
-            body = {
-                '_source': _source,
-                'query': {'match_all': {}},
-                'size': y,
-                'sort': {'_id': 'asc'},
-                'stored_fields': []}
-
-            if x < 10000:
-                body['from'] = x
-            else:
-                body['search_after'] = [search_after]
+    def iter_documents(self, index, _source=False, slices=SCROLL_SLICES,
+                       size=1000, scroll='5m'):
+        """Iterate lazily over the documents as `(_id, _source)` tuples.
+
+        The index is read with a sliced scroll, each slice in its own
+        thread, so the documents come out in no particular order.
+        """
+        body = {'_source': _source, 'size': size, 'sort': ['_doc']}
+
+        if slices < 2:
+            for page in self._scroll(index, body, scroll):
+                yield from page
+            return
+
+        stop = threading.Event()
+        pages = Queue(maxsize=slices * 2)
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=1)
+                except Full:
+                    continue
+                return True
+            return False
 
-            res = self.conn.search(index=index, body=body)
-            yield from res['hits']['hits']
-            x += step
-            search_after = res['hits']['hits'][-1]['_id']
+        def _run(i):
+            try:
+                sliced = dict(body, slice={'id': i, 'max': slices})
+                for page in self._scroll(index, sliced, scroll):
+                    if not _put(page):
+                        break
+            except Exception as e:
+                _put(e)
+            finally:
+                _put(None)
+
+        for i in range(slices):
+            threading.Thread(target=_run, args=(i,), daemon=True).start()
+
+        try:
+            running = slices
+            while running:
+                page = pages.get()
+                if page is None:
+                    running -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    yield from page
+        finally:
+            stop.set()
+
+    def _scroll(self, index, body, scroll):
+        res = self.conn.search(index=index, body=body, scroll=scroll)
+        scroll_id = res.get('_scroll_id')
+        try:
+            while res['hits']['hits']:
+                yield [(hit['_id'], hit.get('_source', {}))
+                       for hit in res['hits']['hits']]
+                res = self.conn.scroll(scroll_id=scroll_id, scroll=scroll)
+                scroll_id = res.get('_scroll_id')
+        finally:
+            if scroll_id:
+                self.conn.clear_scroll(scroll_id=scroll_id, ignore=(404,))
 
     def create_pipeline(self, field='_raw'):
         body = {'description': 'Attachment',
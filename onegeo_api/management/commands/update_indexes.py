@@ -25,10 +25,20 @@ class Command(BaseCommand):
 
     help = 'Update indexes'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--in-place', action='store_true', dest='in_place',
+            help='Apply the changes to the live indexes instead of rebuilding them')
+        parser.add_argument(
+            '--partitions', type=int, dest='partitions',
+            help='Number of subtasks to rebuild each index with')
+
     def handle(self, *args, **kwargs):
         for instance in IndexProfile.objects.all():
             if self.is_index_to_update(instance):
-                self.update_index(instance)
+                self.update_index(
+                    instance, in_place=kwargs.get('in_place'),
+                    partitions=kwargs.get('partitions'))
 
     def is_index_to_update(self, instance):
         now = timezone.now()
@@ -39,14 +49,16 @@ class Command(BaseCommand):
             'monthly': now.day == 1,
             }.get(instance.reindex_frequency, False)
 
-    def update_index(self, instance):
+    def update_index(self, instance, in_place=False, partitions=None):
         task_id = uuid4()
         index = uuid4()  # Id of the index for ES
         indexing.apply_async(
             kwargs={'alias': instance.alias.pk,
                     'force_update': True,
+                    'in_place': bool(in_place),
                     'index': str(index),
                     'index_profile': instance.pk,
+                    'partitions': partitions,
                     'resource_ns': 'index',
                     'user': instance.user.pk},
             task_id=str(task_id))
@@ -0,0 +1,26 @@
+# Copyright (c) 2017-2018 Neogeo-Technologies.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from django.core.management.base import BaseCommand
+from onegeo_api.models import SearchModel
+
+
+class Command(BaseCommand):
+
+    help = 'Update the aliases of the search models'
+
+    def handle(self, *args, **kwargs):
+        SearchModel.put_search_aliases()
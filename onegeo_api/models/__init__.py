@@ -16,6 +16,7 @@
 
 from onegeo_api.models.abstracts import Alias
 from onegeo_api.models.analysis import Analysis
+from onegeo_api.models.index_manifest import IndexManifest
 from onegeo_api.models.index_profile import IndexProfile
 from onegeo_api.models.resource import Resource
 from onegeo_api.models.search_model import SearchModel
@@ -23,4 +24,4 @@ from onegeo_api.models.source import Source
 from onegeo_api.models.task import Task
 
 
-__all__ = [Alias, Analysis, IndexProfile, Resource, SearchModel, Source, Task]
+__all__ = [Alias, Analysis, IndexManifest, IndexProfile, Resource, SearchModel, Source, Task]
@@ -0,0 +1,78 @@
+# Copyright (c) 2017-2018 Neogeo-Technologies.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from django.contrib.postgres.fields import JSONField
+from django.db import models
+from django.db import transaction
+from onegeo_api.utils import DigestSet
+
+
+class IndexManifest(models.Model):
+    """Documents of the live index of an indexation profile.
+
+    The `_md5` ids are stored as sorted 16-byte digests, so that the next
+    indexing can diff against them instead of scanning the index.
+    """
+
+    class Meta(object):
+        verbose_name = 'Index manifest'
+        verbose_name_plural = 'Index manifests'
+
+    index_profile = models.OneToOneField(
+        to='IndexProfile', verbose_name='Indexation profile',
+        related_name='manifest', on_delete=models.CASCADE)
+
+    index = models.CharField(verbose_name='Index', max_length=100)
+
+    columns_mapping = JSONField(verbose_name='Columns mapping')
+
+    generation = models.PositiveIntegerField(
+        verbose_name='Columns mapping generation', default=0)
+
+    count = models.PositiveIntegerField(verbose_name='Count', default=0)
+
+    digests = models.BinaryField(verbose_name='Digests')
+
+    update_date = models.DateTimeField(verbose_name='Update', auto_now=True)
+
+    def iter_ids(self):
+        return iter(DigestSet.from_digests(bytes(self.digests)))
+
+    @classmethod
+    def record(cls, index_profile, index, columns_mapping, ids):
+        """Replace the manifest of `index_profile` by the given documents.
+
+        Do nothing when the ids are not md5 hexadecimal digests.
+        """
+        if not isinstance(ids, DigestSet):
+            try:
+                ids = DigestSet(ids)
+            except (TypeError, ValueError):
+                return None
+
+        with transaction.atomic():
+            instance = cls.objects.select_for_update().filter(
+                index_profile=index_profile).first()
+            if not instance:
+                instance = cls(index_profile=index_profile)
+            elif instance.columns_mapping != columns_mapping:
+                instance.generation += 1
+            instance.index = index
+            instance.columns_mapping = columns_mapping
+            instance.count = len(ids)
+            instance.digests = ids.getvalue()
+            instance.save()
+        return instance
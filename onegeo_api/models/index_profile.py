@@ -50,6 +50,10 @@ class IndexProfile(AbstractModelProfile):
 
     resource = models.ForeignKey(to='Resource', verbose_name='Resource', on_delete=models.CASCADE)
 
+    # Settings of the next indices, prevailing over the planned ones
+    index_settings = JSONField(
+        verbose_name='Index settings', blank=True, null=True)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._onegeo = None
@@ -88,7 +92,7 @@ class IndexProfile(AbstractModelProfile):
 
     @property
     def synchronized(self, *args, **kwargs):
-        return elastic_conn.is_index_exists(index=self.uuid)
+        return bool(elastic_conn.get_indices_by_alias(self.uuid))
 
     @synchronized.setter
     def synchronized(self, *args, **kwargs):
@@ -101,6 +105,7 @@ class IndexProfile(AbstractModelProfile):
     def detail_renderer(self, include=False, cascading=False, **kwargs):
         return {
             'columns': self.columns,
+            'index_settings': self.index_settings,
             'location': self.location,
             'title': self.title,
             'reindex_frequency': self.reindex_frequency,
@@ -119,6 +124,10 @@ class IndexProfile(AbstractModelProfile):
             raise ValidationError(
                 'Some of the input paramaters needed are missing.')
 
+        if self.index_settings is not None \
+                and not isinstance(self.index_settings, dict):
+            raise ValidationError("'index_settings' should be an object.")
+
         if not self.columns:
             self.columns = \
                 [prop.all() for prop in self.onegeo.iter_properties()]
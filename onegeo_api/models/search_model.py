@@ -20,6 +20,8 @@ from django.contrib.sites.shortcuts import get_current_site
 from django.core.exceptions import ValidationError
 from django.db import models
 from django.urls import reverse
+from onegeo_api.elastic import elastic_conn
+from onegeo_api.elastic import GLOBAL_ALIAS
 from onegeo_api.extensions import DEFAULT_QUERY_DSL
 from onegeo_api.models.abstracts import AbstractModelProfile
 import re
@@ -86,6 +88,24 @@ class SearchModel(AbstractModelProfile):
             'service_url': self.service_url,
             'uuid': self.uuid}
 
+    @classmethod
+    def put_search_aliases(cls, deleted=()):
+        """Point the alias of every search model, and the global alias, at
+        the live indices of their indexation profiles.
+
+        The aliases of the `deleted` search models (by uuid) are removed.
+        """
+        members = dict((str(uuid), set()) for uuid in deleted)
+        members[GLOBAL_ALIAS] = set()
+        for uuid in cls.objects.values_list('alias__uuid', flat=True):
+            members[str(uuid)] = set()
+        for search_model, index_profile in \
+                cls.indexes.through.objects.values_list(
+                    'searchmodel__alias__uuid', 'indexprofile__alias__uuid'):
+            members[str(search_model)].add(str(index_profile))
+            members[GLOBAL_ALIAS].add(str(index_profile))
+        elastic_conn.put_search_aliases(members)
+
     @classmethod
     def list_renderer(cls, user, **opts):
         return [
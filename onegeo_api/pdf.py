@@ -0,0 +1,168 @@
+# Copyright (c) 2017-2018 Neogeo-Technologies.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from base64 import b64decode
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+import hashlib
+from io import BytesIO
+import json
+import logging
+from onegeo_api.utils import chunked
+from onegeo_api.utils import map_blocks
+import os
+from pathlib import Path
+import re
+import tempfile
+
+try:
+    from pdfminer.high_level import extract_text
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdfparser import PDFParser
+    from pdfminer.pdftypes import resolve1
+    from pdfminer.utils import decode_text
+except ImportError:
+    extract_text = None
+
+
+logger = logging.getLogger(__name__)
+
+
+# Either 'ingest' (the `attachment` ingest processor of Elasticsearch)
+# or 'local' (text extracted by the worker, requires `pdfminer.six`)
+PDF_EXTRACTION = getattr(settings, 'ONEGEO_PDF_EXTRACTION', 'ingest')
+# Processes extracting the text of the documents (0 extracts it in the
+# worker itself, as each prefork worker is a process already)
+PDF_PROCESSES = getattr(settings, 'ONEGEO_PDF_PROCESSES', 0)
+# Number of documents handed to a process at once
+PDF_CHUNK_SIZE = getattr(settings, 'ONEGEO_PDF_CHUNK_SIZE', 4)
+# Directory where extractions are kept by file hash (None disables)
+PDF_CACHE_DIR = getattr(settings, 'ONEGEO_PDF_CACHE_DIR', None)
+
+# Metadata of the document info dictionary, with the name of the
+# field written by the `attachment` ingest processor
+PDF_METADATA = (
+    ('Title', 'title'),
+    ('Author', 'author'),
+    ('Keywords', 'keywords'),
+    ('CreationDate', 'date'))
+
+
+def _decode(value):
+    value = resolve1(value)
+    if isinstance(value, bytes):
+        return decode_text(value)
+    if isinstance(value, str):
+        return value
+
+
+def _date(value):
+    # PDF dates are written as `D:YYYYMMDDHHmmSS` followed by a time zone
+    match = value and re.match(
+        r'^(?:D:)?(\d{4})(\d{2})?(\d{2})?(\d{2})?(\d{2})?(\d{2})?', value)
+    if not match:
+        return None
+    year, month, day, hour, minute, second = \
+        (x or default for x, default in zip(
+            match.groups(), ('', '01', '01', '00', '00', '00')))
+    return '{}-{}-{}T{}:{}:{}Z'.format(year, month, day, hour, minute, second)
+
+
+def extract(data):
+    """Return the text and metadata of a PDF file.
+
+    The result is shaped as the `attachment` field which the ingest
+    processor would have written.
+    """
+    fp = BytesIO(data)
+    attachment = {'content_type': 'application/pdf'}
+
+    info = PDFDocument(PDFParser(fp)).info
+    for key, field in PDF_METADATA:
+        value = info and _decode(info[0].get(key))
+        if value and field == 'date':
+            value = _date(value)
+        if value:
+            attachment[field] = value
+
+    fp.seek(0)
+    content = extract_text(fp).strip()
+    attachment['content'] = content
+    attachment['content_length'] = len(content)
+    return attachment
+
+
+def _cache_path(digest):
+    return Path(PDF_CACHE_DIR, digest[:2], '{}.json'.format(digest))
+
+
+def extract_cached(data):
+    """Same as `extract` but read from and written to the cache."""
+    if not PDF_CACHE_DIR:
+        return extract(data)
+
+    path = _cache_path(hashlib.md5(data).hexdigest())
+    try:
+        with path.open(encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    attachment = extract(data)
+
+    # Written aside then moved, so that no process reads a partial file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(attachment, f, ensure_ascii=False)
+        os.replace(tmp, str(path))
+    except OSError as e:
+        logger.warning('Unable to cache PDF extraction: {}'.format(e))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return attachment
+
+
+def extract_documents(documents, field='_raw'):
+    """Replace the base64 encoded file of each of `documents` by its text.
+
+    A document whose text cannot be extracted is given an `_error`, so
+    that it is reported as failed rather than indexed without text.
+    """
+    for document in documents:
+        raw = document.pop(field, None)
+        if not raw:
+            continue
+        try:
+            document['attachment'] = extract_cached(b64decode(raw))
+        except Exception as e:
+            document['_error'] = 'Unable to extract PDF: {}'.format(e)
+    return documents
+
+
+def iter_extracted(collection, processes=PDF_PROCESSES,
+                   chunk_size=PDF_CHUNK_SIZE):
+    """Extract the text of the PDF documents of `collection` locally."""
+    if extract_text is None:
+        raise ImproperlyConfigured(
+            "ONEGEO_PDF_EXTRACTION = 'local' requires 'pdfminer.six'.")
+
+    extracted = map_blocks(
+        extract_documents, chunked(collection, chunk_size),
+        processes=processes or 0)
+    for _, documents in extracted:
+        yield from documents
@@ -14,11 +14,16 @@
 # under the License.
 
 
+from django.db.models.signals import m2m_changed
 from django.db.models.signals import post_delete
+from django.db.models.signals import post_migrate
 from django.db.models.signals import post_save
 from django.dispatch import receiver
+import logging
 from onegeo_api.celery_tasks import data_source_analyzing
+from onegeo_api.celery_tasks import index_built
 from onegeo_api.elastic import elastic_conn
+from onegeo_api.exceptions import ElasticError
 from onegeo_api.models import IndexProfile
 from onegeo_api.models import Resource
 from onegeo_api.models import SearchModel
@@ -26,6 +31,20 @@ from onegeo_api.models import Source
 from uuid import uuid4
 
 
+logger = logging.getLogger(__name__)
+
+
+def sync_search_aliases(deleted=()):
+    # Elasticsearch being unavailable does not fail the change of a model,
+    # the aliases are then to be updated by hand
+    try:
+        SearchModel.put_search_aliases(deleted=deleted)
+    except ElasticError as e:
+        logger.warning(
+            "Unable to update the aliases of the search models "
+            "(run 'manage.py update_search_aliases'): {}".format(e))
+
+
 @receiver(post_save, sender=Source)
 def create_related_resource(sender, instance, **kwargs):
     if kwargs.get('created') is True:
@@ -39,7 +58,10 @@ def create_related_resource(sender, instance, **kwargs):
 
 @receiver(post_delete, sender=IndexProfile)
 def delete_elastic_related_index(sender, instance, **kwargs):
-    for index in elastic_conn.get_indices_by_alias(instance.uuid):
+    # The live index, then the former ones
+    indices = elastic_conn.get_indices_by_alias(instance.uuid, fresh=True)
+    indices += elastic_conn.list_generations(instance.uuid)
+    for index in indices:
         elastic_conn.delete_index(index)
 
 
@@ -49,6 +71,32 @@ def remove_index_from_search_model(sender, instance, **kwargs):
     pass
 
 
+@receiver(m2m_changed, sender=SearchModel.indexes.through)
+def update_search_aliases(sender, action, **kwargs):
+    # Once per call of `add`, `remove` or `clear`
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        sync_search_aliases()
+
+
+@receiver(index_built, sender=IndexProfile)
+def add_index_to_search_aliases(sender, instance, **kwargs):
+    # A rebuilt index inherits the aliases of the former one, not a first one
+    sync_search_aliases()
+
+
+@receiver(post_migrate)
+def create_search_aliases(sender, **kwargs):
+    # Searches go through these aliases, which an upgrade has to create
+    if sender.label != 'onegeo_api':
+        return
+    sync_search_aliases()
+
+
+@receiver(post_delete, sender=SearchModel)
+def delete_search_alias(sender, instance, **kwargs):
+    sync_search_aliases(deleted=[instance.uuid])
+
+
 @receiver(post_delete, sender=SearchModel)
 @receiver(post_delete, sender=Source)
 @receiver(post_delete, sender=Resource)
@@ -20,6 +20,7 @@ from onegeo_api.views.catalog import Catalog
 from onegeo_api.views.index_profile import IndexProfilesDetail
 from onegeo_api.views.index_profile import IndexProfilesIndexing
 from onegeo_api.views.index_profile import IndexProfilesList
+from onegeo_api.views.index_profile import IndexProfilesRollback
 # from onegeo_api.views.index_profile import IndexProfilesTasksDetail
 # from onegeo_api.views.index_profile import IndexProfilesTasksList
 from onegeo_api.views import Protocols
@@ -50,6 +51,7 @@ urlpatterns = (
     # url('^indexes/(\w+)/tasks/(\d+)/?$', IndexProfilesTasksDetail.as_view(), name='index_task'),
     # url('^indexes/(\w+)/tasks/?$', IndexProfilesTasksList.as_view(), name='index_tasks'),
 
+    url('^indexes/(?P<name>(\w|-){1,100})/index/rollback/?$', IndexProfilesRollback.as_view(), name='index_rollback'),
     url('^indexes/(?P<name>(\w|-){1,100})/index/?$', IndexProfilesIndexing.as_view(), name='index'),
     url('^indexes/(?P<name>(\w|-){1,100})/?$', IndexProfilesDetail.as_view(), name='index_profile'),
     url('^indexes/?$', IndexProfilesList.as_view(), name='index_profiles'),
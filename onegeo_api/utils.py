@@ -15,17 +15,30 @@
 
 
 from base64 import b64decode
+from billiard.pool import Pool
 from collections import deque
-from collections import Mapping
 from django.contrib.auth import authenticate
 from django.core.handlers.wsgi import WSGIRequest
 from django.http import HttpResponse
 from django.http import HttpResponseRedirect
+from elasticsearch.serializer import JSONSerializer
 from functools import wraps
-from numbers import Number
+import json
 from onegeo_api.exceptions import ConflictError
 from pathlib import Path
-import sys
+from queue import Empty
+from queue import Full
+from queue import Queue
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_json_serializer = JSONSerializer()
 
 
 class HttpResponseSeeOther(HttpResponseRedirect):
@@ -76,6 +89,307 @@ class Singleton(type):
         return cls.__instances[cls]
 
 
+class Cursor(object):
+    """Iterate over `iterable` keeping count of the items consumed."""
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.position = 0
+
+    def __iter__(self):
+        for item in self.iterable:
+            self.position += 1
+            yield item
+
+
+class DigestSet(object):
+    """Set of md5 ids stored as 16-byte digests in a contiguous buffer.
+
+    Ids are given and returned as hexadecimal strings. Digests added out
+    of order are sorted (and deduplicated) on the next lookup, so that
+    membership is a binary search and set operations are merges. NumPy,
+    when installed, does the sorting and the set operations.
+    """
+
+    SIZE = 16
+
+    def __init__(self, ids=()):
+        self._buffer = bytearray()
+        self._sorted = True
+        self._array = None
+        self.update(ids)
+
+    @classmethod
+    def from_digests(cls, digests):
+        """Return a set of the sorted and distinct digests of `digests`."""
+        instance = cls()
+        instance._buffer = bytearray(digests)
+        return instance
+
+    def add(self, _id):
+        digest = bytes.fromhex(_id)
+        if len(digest) != self.SIZE:
+            raise ValueError("'{}' is not a md5 digest.".format(_id))
+        # Ids added in increasing order keep the buffer sorted
+        if self._sorted and self._buffer \
+                and digest <= self._buffer[-self.SIZE:]:
+            self._sorted = False
+        self._buffer += digest
+        self._array = None
+
+    def update(self, ids):
+        if isinstance(ids, DigestSet):
+            ids._compact()
+            self._sorted = self._sorted and not self._buffer and ids._sorted
+            self._buffer += ids._buffer
+            self._array = None
+            return
+        for _id in ids:
+            self.add(_id)
+
+    def _digests(self):
+        buffer = self._buffer
+        for i in range(0, len(buffer), self.SIZE):
+            yield bytes(buffer[i:i + self.SIZE])
+
+    def _compact(self):
+        if self._sorted:
+            return
+        if numpy is not None:
+            array = numpy.unique(numpy.frombuffer(
+                bytes(self._buffer), dtype='S{}'.format(self.SIZE)))
+            self._buffer = bytearray(array.tobytes())
+        else:
+            self._buffer = bytearray(b''.join(sorted(set(self._digests()))))
+        self._sorted = True
+
+    def _as_array(self):
+        self._compact()
+        if self._array is None:
+            self._array = numpy.frombuffer(
+                bytes(self._buffer), dtype='S{}'.format(self.SIZE))
+        return self._array
+
+    def __len__(self):
+        self._compact()
+        return len(self._buffer) // self.SIZE
+
+    def __bool__(self):
+        return bool(self._buffer)
+
+    def __iter__(self):
+        self._compact()
+        for digest in self._digests():
+            yield digest.hex()
+
+    def __contains__(self, _id):
+        try:
+            digest = bytes.fromhex(_id)
+        except (TypeError, ValueError):
+            return False
+        self._compact()
+        buffer, size = self._buffer, self.SIZE
+        lo, hi = 0, len(buffer) // size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if buffer[mid * size:(mid + 1) * size] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        return buffer[lo * size:(lo + 1) * size] == digest
+
+    def _merge(self, other, keep):
+        # `keep` tells from the presence of a digest in each of the sets
+        # whether it belongs to the result.
+        self._compact()
+        other._compact()
+        res = bytearray()
+        a, b = self._digests(), other._digests()
+        x, y = next(a, None), next(b, None)
+        while x is not None or y is not None:
+            if y is None or (x is not None and x < y):
+                if keep(True, False):
+                    res += x
+                x = next(a, None)
+            elif x is None or y < x:
+                if keep(False, True):
+                    res += y
+                y = next(b, None)
+            else:
+                if keep(True, True):
+                    res += x
+                x, y = next(a, None), next(b, None)
+        return DigestSet.from_digests(res)
+
+    def _operation(self, other, name, keep):
+        if not isinstance(other, DigestSet):
+            other = DigestSet(other)
+        if numpy is not None:
+            array = getattr(numpy, name)(
+                self._as_array(), other._as_array(), assume_unique=True)
+            return DigestSet.from_digests(numpy.sort(array).tobytes())
+        return self._merge(other, keep)
+
+    def __sub__(self, other):
+        return self._operation(other, 'setdiff1d', lambda x, y: x and not y)
+
+    def __and__(self, other):
+        return self._operation(other, 'intersect1d', lambda x, y: x and y)
+
+    def __or__(self, other):
+        if not isinstance(other, DigestSet):
+            other = DigestSet(other)
+        res = DigestSet()
+        res.update(self)
+        res.update(other)
+        return res
+
+    def getvalue(self):
+        """Return the sorted digests as bytes."""
+        self._compact()
+        return bytes(self._buffer)
+
+
+class Prefetcher(object):
+    """Read `iterable` from a background thread into a bounded queue.
+
+    The queue depth is sampled at each item consumed, and the waits of
+    both sides are counted: a consumer often waiting means the source is
+    the bottleneck, a producer often waiting means the consumer is.
+    """
+
+    def __init__(self, iterable, maxsize=1000):
+        self.iterable = iterable
+        self.maxsize = maxsize
+        self.depth = 0
+        self.count = 0
+        self.consumer_waits = 0
+        self.consumer_wait_time = 0
+        self.producer_waits = 0
+        self.producer_wait_time = 0
+
+    def __iter__(self):
+        if self.maxsize < 1:
+            yield from self.iterable
+            return
+
+        stop = threading.Event()
+        queue = Queue(maxsize=self.maxsize)
+        done = object()
+
+        def _put(item):
+            try:
+                queue.put_nowait(item)
+                return True
+            except Full:
+                pass
+            self.producer_waits += 1
+            start = time.monotonic()
+            try:
+                while not stop.is_set():
+                    try:
+                        queue.put(item, timeout=1)
+                    except Full:
+                        continue
+                    return True
+                return False
+            finally:
+                self.producer_wait_time += time.monotonic() - start
+
+        def _run():
+            try:
+                for item in self.iterable:
+                    if not _put(item):
+                        return
+            except Exception as e:
+                _put(Raised(e))
+            finally:
+                _put(done)
+
+        threading.Thread(target=_run, daemon=True).start()
+
+        try:
+            while True:
+                self.depth += queue.qsize()
+                try:
+                    item = queue.get_nowait()
+                except Empty:
+                    self.consumer_waits += 1
+                    start = time.monotonic()
+                    item = queue.get()
+                    self.consumer_wait_time += time.monotonic() - start
+                if item is done:
+                    break
+                if isinstance(item, Raised):
+                    raise item.exception
+                self.count += 1
+                yield item
+        finally:
+            stop.set()
+
+    def summary(self):
+        return {
+            'size': self.maxsize,
+            'count': self.count,
+            'mean_depth': self.count and round(self.depth / self.count, 2),
+            'consumer_waits': self.consumer_waits,
+            'consumer_wait_time': round(self.consumer_wait_time, 3),
+            'producer_waits': self.producer_waits,
+            'producer_wait_time': round(self.producer_wait_time, 3)}
+
+
+class Raised(object):
+    """Exception raised by a background thread, to be raised again."""
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def chunked(iterable, size):
+    """Yield lists of (at most) `size` items of `iterable`."""
+    block = []
+    for item in iterable:
+        block.append(item)
+        if len(block) >= size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def map_blocks(func, blocks, *args, processes=0):
+    """Yield `(block, func(*args, block))` for each of `blocks`, in order.
+
+    With `processes`, `func` runs in a process pool at most twice as many
+    blocks ahead of the consumer. The pool is that of `billiard` (on which
+    Celery relies), whose processes may be started from a daemonic one
+    such as a prefork worker, unlike those of `multiprocessing`.
+    """
+    if not processes:
+        for block in blocks:
+            yield block, func(*args, block)
+        return
+
+    pending = deque()
+    pool = Pool(processes=processes)
+    try:
+        for block in blocks:
+            while len(pending) >= processes * 2:
+                result, done = pending.popleft()
+                yield done, result.get()
+            pending.append((pool.apply_async(func, (*args, block)), block))
+        while pending:
+            result, done = pending.popleft()
+            yield done, result.get()
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
 def clean_my_obj(obj):
     if isinstance(obj, (list, tuple, set)):
         return type(obj)(clean_my_obj(x) for x in obj if x is not None)
@@ -120,32 +434,11 @@ def subdirectories(root):
     return [x.as_uri() for x in p.iterdir() if x.is_dir()]
 
 
-def estimate_size(obj):
-    """Recursively iterate to sum size of object."""
-    done = []
-
-    def inner(sub):
-        if id(sub) in done:
-            return 0
-
-        sizeof = sys.getsizeof(sub)
-        if isinstance(sub, (str, bytes, Number, range, bytearray)):
-            pass  # bypass remaining control flow and return
-        elif isinstance(sub, (tuple, list, set, deque)):
-            sizeof += sum(inner(i) for i in sub)
-        elif isinstance(sub, Mapping) or hasattr(sub, 'items'):
-            sizeof += sum(inner(k) + inner(v) for k, v in getattr(sub, 'items')())
-
-        # Check for custom object instances - may subclass above too
-        if hasattr(sub, '__dict__'):
-            sizeof += inner(vars(sub))
-        if hasattr(sub, '__slots__'):  # can have __slots__ with __dict__
-            sizeof += sum(inner(getattr(sub, s)) for s in sub.__slots__ if hasattr(sub, s))
-
-        done.append(id(obj))
-        return sizeof
-
-    return inner(obj)
+def json_dumps(obj):
+    """Serialize `obj` to compact UTF-8 encoded JSON."""
+    return json.dumps(
+        obj, default=_json_serializer.default,
+        ensure_ascii=False, separators=(',', ':')).encode('utf-8')
 
 
 def pagination_handler(f):
@@ -26,10 +26,11 @@ from django.views.generic import View
 import json
 from onegeo_api.celery_tasks import indexing
 from onegeo_api.elastic import elastic_conn
+from onegeo_api.elastic import plan_index_settings
 from onegeo_api.exceptions import ElasticError
 from onegeo_api.models import IndexProfile
 from onegeo_api.models import Resource
-# from onegeo_api.models import Task
+from onegeo_api.models import Task
 from onegeo_api.utils import BasicAuth
 import re
 from uuid import uuid4
@@ -114,16 +115,50 @@ class IndexProfilesDetail(View):
                 '^(false|no)$', params.pop('_force_update'), flags=re.IGNORECASE):
             force_update = True
 
+        in_place = False
+        if '_in_place' in params and not re.match(
+                '^(false|no)$', params.pop('_in_place'), flags=re.IGNORECASE):
+            in_place = True
+
+        partitions = None
+        if '_partitions' in params:
+            try:
+                partitions = int(params.pop('_partitions'))
+            except ValueError as e:
+                return JsonResponse({'error': e.__str__()}, status=400)
+
         task_id = uuid4()
         index = uuid4()
-        indexing.apply_async(
-            kwargs={'alias': index_profile.alias.pk,
-                    'force_update': force_update,
-                    'index': str(index),
-                    'index_profile': index_profile.pk,
-                    'resource_ns': 'index',
-                    'user': request.user.pk},
-            task_id=str(task_id))
+        kwargs = {'alias': index_profile.alias.pk,
+                  'force_update': force_update,
+                  'in_place': in_place,
+                  'index': str(index),
+                  'index_profile': index_profile.pk,
+                  'partitions': partitions,
+                  'resource_ns': 'index',
+                  'user': request.user.pk}
+
+        if '_resume' in params and not re.match(
+                '^(false|no)$', params.pop('_resume'), flags=re.IGNORECASE):
+            interrupted = Task.logged.filter(
+                alias=index_profile.alias, task_name='indexing',
+                details__has_key='checkpoint').exclude(
+                success=True).order_by('-start_date').first()
+            if not interrupted:
+                msg = 'There is no interrupted indexing task to resume.'
+                return JsonResponse({'error': msg}, status=400)
+            checkpoint = interrupted.details['checkpoint']
+            if checkpoint['index'] in elastic_conn.get_indices_by_alias(
+                    index_profile.uuid, fresh=True):
+                msg = 'The interrupted indexing task has been completed.'
+                return JsonResponse({'error': msg}, status=400)
+            kwargs.update({
+                'force_update': checkpoint.get('force_update', False),
+                'in_place': False,
+                'index': checkpoint['index'],
+                'resume': str(interrupted.uuid)})
+
+        indexing.apply_async(kwargs=kwargs, task_id=str(task_id))
 
         response = HttpResponse(status=202)
         response['Content-Location'] = reverse(
@@ -148,7 +183,9 @@ class IndexProfilesDetail(View):
                 ', '.join("'{}'".format(str(item)) for item in fields.difference(expected)))
             return JsonResponse({'error': msg}, status=400)
 
-        data = dict((k, v) for k, v in data.items() if k in fields)
+        data = dict(
+            (k, v) for k, v in data.items()
+            if k in fields or k == 'index_settings')
 
         if data['resource'] != index_profile.resource.location:
             msg = 'The resource could not be changed'
@@ -230,3 +267,42 @@ class IndexProfilesIndexing(View):
                 status=e.status_code)
 
         return HttpResponse(status=204)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class IndexProfilesRollback(View):
+
+    @BasicAuth()
+    def get(self, request, name):
+        index_profile = IndexProfile.get_or_raise(name, user=request.user)
+        alias = str(index_profile.uuid)
+
+        try:
+            return JsonResponse(
+                data={'index': elastic_conn.get_indices_by_alias(alias),
+                      'generations': elastic_conn.list_generations(alias)},
+                status=200)
+        except ElasticError as e:
+            return JsonResponse(
+                data={'error': e.__str__(), 'details': e.details},
+                status=e.status_code)
+
+    @BasicAuth()
+    def post(self, request, name):
+        index_profile = IndexProfile.get_or_raise(name, user=request.user)
+
+        params = dict((k, ','.join(v)) for k, v in dict(request.GET).items())
+
+        try:
+            number_of_replicas = plan_index_settings(
+                data_nodes=elastic_conn.count_data_nodes(),
+                overrides=index_profile.index_settings)['number_of_replicas']
+            index = elastic_conn.rollback(
+                str(index_profile.uuid), index=params.get('_index'),
+                number_of_replicas=number_of_replicas)
+        except ElasticError as e:
+            return JsonResponse(
+                data={'error': e.__str__(), 'details': e.details},
+                status=e.status_code)
+
+        return JsonResponse(data={'index': index}, status=200)
@@ -25,6 +25,7 @@ from django.views.generic import View
 from importlib import import_module
 import json
 from onegeo_api.elastic import elastic_conn
+from onegeo_api.elastic import GLOBAL_ALIAS
 from onegeo_api.exceptions import ElasticError
 from onegeo_api.models import IndexProfile
 from onegeo_api.models import SearchModel
@@ -75,13 +76,16 @@ class SearchModelsList(View):
         except IntegrityError as e:
             return JsonResponse(data={'error': e.__str__()}, status=409)
 
+        index_profiles = []
         for item in indexes:
             try:
                 val = re.search('indexes/(\w+)/?$', item).group(1)
             except AttributeError as e:
                 return JsonResponse(data={'error': e.__str__()}, status=400)
-            instance.indexes.add(
+            index_profiles.append(
                 IndexProfile.get_or_raise(val, user=data['user']))
+        # At once, so that the search aliases are updated once
+        instance.indexes.add(*index_profiles)
 
         response = HttpResponse(status=201)
         response['Content-Location'] = instance.location
@@ -170,21 +174,15 @@ class Search(View):
             if len(auth) == 2 and auth[0].lower() == 'basic':
                 user, password = b64decode(auth[1]).decode('utf-8').split(':')
 
+        # Each search model has its alias, and every one the global alias
         if name == '_all':
-            index_profiles = [
-                m.indexprofile for m in
-                SearchModel.indexes.through.objects.filter(
-                    searchmodel__in=SearchModel.objects.all())]
+            index = GLOBAL_ALIAS
         else:
             try:
                 instance = SearchModel.get_or_raise(name)
             except SearchModel.DoesNotExist:
                 return HttpResponse(status=404)
-            index_profiles = [
-                m.indexprofile for m in
-                SearchModel.indexes.through.objects.filter(searchmodel=instance)]
-
-        index = [m.uuid for m in index_profiles]
+            index = instance.uuid
 
         params = dict((k, ','.join(v)) for k, v in dict(request.GET).items())
         if '_through' in params and not re.match(
@@ -204,6 +202,7 @@ class Search(View):
         except ImportError:
             ext = import_module('...extensions.__init__', __name__)
         # else:
+        index_profiles = list(instance.indexes.all())
         try:
             plugin = ext.plugin(instance.query_dsl, index_profiles,
                                 user=user, password=password)
@@ -235,21 +234,15 @@ class Search(View):
             if len(auth) == 2 and auth[0].lower() == 'basic':
                 user, password = b64decode(auth[1]).decode('utf-8').split(':')
 
+        # Each search model has its alias, and every one the global alias
         if name == '_all':
-            index_profiles = [
-                m.indexprofile for m in
-                SearchModel.indexes.through.objects.filter(
-                    searchmodel__in=SearchModel.objects.all())]
+            index = GLOBAL_ALIAS
         else:
             try:
                 instance = SearchModel.get_or_raise(name)
             except SearchModel.DoesNotExist:
                 return HttpResponse(status=404)
-            index_profiles = [
-                m.indexprofile for m in
-                SearchModel.indexes.through.objects.filter(searchmodel=instance)]
-
-        index = [m.uuid for m in index_profiles]
+            index = instance.uuid
 
         params = dict((k, ','.join(v)) for k, v in dict(request.GET).items())
 